@@ -1,6 +1,8 @@
 import xml.etree.ElementTree as ET
 import json
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
 import time
 import urllib.parse
@@ -10,15 +12,42 @@ from datetime import datetime
 from PIL import Image
 from io import BytesIO
 import base64
+import hashlib
+import functools
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 # ----- BILDVALIDERINGS-CACHE -----
 CACHE_FILE = "chevalier_image_imported.json"
+# Append-only logg med en URL (JSON-sträng) per rad, importerad sedan senaste sparningen av CACHE_FILE
+CACHE_JOURNAL_FILE = "chevalier_image_imported.jsonl"
 VALIDATION_CACHE_FILE = "chevalier_validation_cache.json"
+# Resizade bilder (JPEG) sparas här tills bilden är uppladdad, så att en misslyckad uppladdning
+# inte behöver hämta och resiza bilden igen nästa körning
+RESIZED_CACHE_DIR = "chevalier_resized_cache"
+# Befintliga smart collections (titel -> ID), återanvänds vid omkörningar inom SMART_COLLECTIONS_CACHE_TTL
+SMART_COLLECTIONS_CACHE_FILE = "chevalier_smart_collections.json"
+SMART_COLLECTIONS_CACHE_TTL = 15 * 60  # sekunder
+SMART_COLLECTIONS_CACHE_VERSION = "v1"  # Ändra vid nytt cacheformat så att gamla filer ignoreras
 
 # Bildvaliderings-gränser (Google Shopping-kompatibla)
 MAX_SIZE_MB = 16  # Google Shopping max (16MB)
 MAX_PIXELS = 8000  # Google Shopping max (64 megapixels ≈ 8000x8000)
 RESIZE_MAX_DIMENSION = 1500  # Google Shopping rekommendation (1500x1500)
+IMAGE_PROBE_BYTES = 64 * 1024  # Räcker för JPEG/PNG-headern i nästan alla bilder
+
+# Antal produkter vars bilder förbereds parallellt med Shopify-uppladdningen
+EXTRACT_WORKERS = 4
+
+# Antal bilder per produkt som hämtas/valideras samtidigt (totalt EXTRACT_WORKERS * IMAGE_WORKERS)
+IMAGE_WORKERS = 4
+
+# Antal smart collections som skapas samtidigt
+SMART_COLLECTION_WORKERS = 4
+
+# Spara cachen till disk efter så här många produkter (skydd mot avbrott)
+CACHE_CHECKPOINT_INTERVAL = 100
 
 if os.path.exists(CACHE_FILE):
     with open(CACHE_FILE, "r") as f:
@@ -26,16 +55,47 @@ if os.path.exists(CACHE_FILE):
 else:
     image_import_cache = {}
 
+# Spela upp loggen så att importer från en avbruten körning inte går förlorade
+journal_line = ""
+if os.path.exists(CACHE_JOURNAL_FILE):
+    with open(CACHE_JOURNAL_FILE, "r") as f:
+        for journal_line in f:
+            try:
+                image_import_cache[json.loads(journal_line)] = True
+            except ValueError:
+                pass  # Halvskriven sista rad om körningen dödades mitt i en skrivning
+image_import_journal = open(CACHE_JOURNAL_FILE, "a")
+if journal_line and not journal_line.endswith("\n"):
+    image_import_journal.write("\n")  # Nya rader ska inte hamna efter en halvskriven rad
+
 if os.path.exists(VALIDATION_CACHE_FILE):
     with open(VALIDATION_CACHE_FILE, "r") as f:
         image_validation_cache = json.load(f)
 else:
     image_validation_cache = {}
-
-def resize_image(image_data, max_dimension=RESIZE_MAX_DIMENSION):
-    """Resiza och optimera en bild till max dimension"""
+validation_cache_lock = threading.Lock()
+
+# Egen session för bildhämtning (bildvärden, inte Shopify): håller anslutningar öppna
+# mellan bilderna och delas av trådarna som förbereder produkter
+image_session = requests.Session()
+image_session.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=32,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=frozenset(["GET", "HEAD"]),
+        raise_on_status=False,
+    ),
+))
+
+def resize_image(img, max_dimension=RESIZE_MAX_DIMENSION):
+    """Resiza och optimera en redan öppnad bild (PIL Image) till max dimension"""
     try:
-        img = Image.open(BytesIO(image_data))
+        # Låt JPEG-avkodaren skala ner direkt (1/2, 1/4, 1/8) istället för att avkoda hela bilden.
+        # Måste ske innan konverteringen nedan, som annars läser in bilden i full storlek.
+        img.draft('RGB', (max_dimension, max_dimension))
 
         # Konvertera RGBA/LA/P till RGB (ta bort alpha channel)
         if img.mode in ('RGBA', 'LA', 'P'):
@@ -51,9 +111,11 @@ def resize_image(image_data, max_dimension=RESIZE_MAX_DIMENSION):
         # Resiza med bibehållen aspect ratio
         img.thumbnail((max_dimension, max_dimension), Image.Resampling.LANCZOS)
 
-        # Spara optimerad som JPEG
+        # Spara som JPEG med standardtabeller. Bilden laddas upp en gång och markeras sedan som
+        # importerad, så ett extra Huffman-pass (optimize) skulle bara göra kodningen långsammare
+        # för några procents mindre fil; quality=85 avgör bildkvaliteten
         output = BytesIO()
-        img.save(output, format='JPEG', quality=85, optimize=True)
+        img.save(output, format='JPEG', quality=85, optimize=False, progressive=False)
         output.seek(0)
 
         return output.getvalue()
@@ -61,6 +123,57 @@ def resize_image(image_data, max_dimension=RESIZE_MAX_DIMENSION):
         print(f"⚠️ Kunde inte resiza bild: {e}")
         return None
 
+def get_resized_cache_path(url):
+    return os.path.join(RESIZED_CACHE_DIR, hashlib.sha1(url.encode("utf-8")).hexdigest() + ".jpg")
+
+def remove_resized_image(url):
+    # Importerade bilder förbereds aldrig igen, så den resizade filen behövs inte längre
+    try:
+        os.remove(get_resized_cache_path(url))
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print(f"⚠️ Kunde inte ta bort resizad bild från cache: {e}")
+
+# Rensa bort resizade bilder från tidigare körningar vars URL redan är importerad
+if os.path.isdir(RESIZED_CACHE_DIR):
+    imported_resized_names = {os.path.basename(get_resized_cache_path(url)) for url in image_import_cache}
+    for name in os.listdir(RESIZED_CACHE_DIR):
+        if name in imported_resized_names:
+            os.remove(os.path.join(RESIZED_CACHE_DIR, name))
+
+def build_resized_attachment(url, resized_data):
+    """Bygg Shopify attachment (base64) för en resizad bild, med .jpg-filnamn från URL:en"""
+    filename = os.path.basename(urllib.parse.urlparse(url).path)
+    if not filename.lower().endswith(('.jpg', '.jpeg')):
+        filename = os.path.splitext(filename)[0] + '.jpg'
+    return {
+        "attachment": base64.b64encode(resized_data).decode('ascii'),
+        "filename": filename
+    }
+
+def fetch_image(url, max_bytes=None):
+    """
+    Hämta en bild, eller bara de första max_bytes (Range-anrop).
+    Returnerar (data, total storlek i bytes) eller None om bilden inte kunde hämtas.
+    Total storlek är None om servern svarade med en del av bilden utan att ange storleken.
+    Servrar som inte stödjer Range svarar med hela bilden (200), vilket också fungerar.
+    """
+    headers = {"Range": f"bytes=0-{max_bytes - 1}"} if max_bytes else None
+    resp = image_session.get(url, timeout=20, headers=headers)
+    if resp.status_code == 206:
+        total = resp.headers.get("Content-Range", "").rpartition("/")[2]
+        return resp.content, int(total) if total.isdigit() else None
+    if resp.status_code == 200:
+        return resp.content, len(resp.content)
+    return None
+
+def fetch_full_image(url):
+    fetched = fetch_image(url)
+    if fetched is None:
+        raise IOError("Bild kunde inte hämtas")
+    return fetched[0]
+
 def prepare_image_for_shopify(url):
     """
     Hämtar och förbereder en bild för Shopify.
@@ -78,23 +191,39 @@ def prepare_image_for_shopify(url):
         if cache_entry.get("valid") and not cache_entry.get("resized"):
             return {"src": url}
         elif cache_entry.get("resized"):
-            # Behöver ladda om och resiza varje gång (vi cachar inte base64)
-            pass
+            # Använd den sparade resizade bilden om den finns, annars hämta och resiza igen
+            try:
+                with open(get_resized_cache_path(url), "rb") as f:
+                    return build_resized_attachment(url, f.read())
+            except OSError:
+                pass
         elif not cache_entry.get("valid") and cache_entry.get("failed"):
             return None
 
     try:
-        # Försök hämta bilden
-        resp = requests.get(url, timeout=20)
-        if resp.status_code != 200:
+        # Hämta bara början av bilden först - dimensionerna står i headern och
+        # den totala storleken i Content-Range, så hela bilden behövs bara vid resize
+        fetched = fetch_image(url, IMAGE_PROBE_BYTES)
+        if fetched is None:
             print(f"⚠️ Bild kunde inte hämtas: {url}")
-            image_validation_cache[url] = {"valid": False, "failed": True}
+            set_validation_result(url, {"valid": False, "failed": True})
             return None
 
-        image_data = resp.content
-        img = Image.open(BytesIO(image_data))
+        image_data, total_size = fetched
+        is_complete = len(image_data) == total_size
+        try:
+            img = Image.open(BytesIO(image_data))
+        except Exception:
+            if is_complete:
+                raise
+            img = None  # Headern fick inte plats i de första byten (t.ex. stor EXIF/ICC-data)
+        if img is None or total_size is None:
+            image_data = fetch_full_image(url)
+            total_size = len(image_data)
+            is_complete = True
+            img = Image.open(BytesIO(image_data))
         width, height = img.width, img.height
-        size_mb = len(image_data) / (1024 * 1024)
+        size_mb = total_size / (1024 * 1024)
 
         # Kolla om bilden behöver resizas
         needs_resize = (
@@ -105,63 +234,84 @@ def prepare_image_for_shopify(url):
 
         if needs_resize:
             print(f"📐 Resizar bild: {url} ({width}x{height}, {size_mb:.1f}MB) → max {RESIZE_MAX_DIMENSION}x{RESIZE_MAX_DIMENSION}")
-            resized_data = resize_image(image_data)
+            if not is_complete:
+                img = Image.open(BytesIO(fetch_full_image(url)))
+            # Återanvänd den öppnade bilden - Pillow har bara läst headern än så länge
+            resized_data = resize_image(img)
 
             if resized_data:
-                # Konvertera till base64 för Shopify attachment
-                base64_data = base64.b64encode(resized_data).decode('utf-8')
-
-                # Extrahera filnamn från URL
-                filename = os.path.basename(urllib.parse.urlparse(url).path)
-                if not filename.lower().endswith(('.jpg', '.jpeg')):
-                    filename = os.path.splitext(filename)[0] + '.jpg'
+                # Spara den resizade bilden till nästa körning
+                try:
+                    os.makedirs(RESIZED_CACHE_DIR, exist_ok=True)
+                    with open(get_resized_cache_path(url), "wb") as f:
+                        f.write(resized_data)
+                except OSError as e:
+                    print(f"⚠️ Kunde inte spara resizad bild i cache: {e}")
 
                 # Cacha att denna bild behöver resizas
-                image_validation_cache[url] = {
+                set_validation_result(url, {
                     "valid": True,
                     "resized": True,
                     "original_size": f"{width}x{height}",
                     "original_mb": round(size_mb, 1)
-                }
+                })
 
-                return {
-                    "attachment": base64_data,
-                    "filename": filename
-                }
+                # Konvertera till base64 för Shopify attachment
+                return build_resized_attachment(url, resized_data)
             else:
                 print(f"⚠️ Kunde inte resiza bild: {url}")
-                image_validation_cache[url] = {"valid": False, "failed": True}
+                set_validation_result(url, {"valid": False, "failed": True})
                 return None
         else:
             # Bilden är OK som den är
-            image_validation_cache[url] = {
+            set_validation_result(url, {
                 "valid": True,
                 "width": width,
                 "height": height,
                 "size_mb": round(size_mb, 1)
-            }
+            })
             return {"src": url}
 
     except Exception as e:
         print(f"⚠️ Bildproblem: {url} - {e}")
-        image_validation_cache[url] = {"valid": False, "failed": True}
+        set_validation_result(url, {"valid": False, "failed": True})
         return None
 
+def set_validation_result(url, entry):
+    # Bilderna förbereds i flera trådar; låset hindrar att cachen ändras medan den sparas
+    with validation_cache_lock:
+        image_validation_cache[url] = entry
+
 def is_image_imported(url):
-    return image_import_cache.get(url, False)
+    return url in image_import_cache
 
 def mark_image_imported(url):
+    # En rad i loggen istället för att skriva om hela cachefilen för varje bild
+    if url in image_import_cache:
+        return
     image_import_cache[url] = True
-    with open(CACHE_FILE, "w") as f:
-        json.dump(image_import_cache, f)
+    image_import_journal.write(json.dumps(url) + "\n")
+    image_import_journal.flush()
+    if image_validation_cache.get(url, {}).get("resized"):
+        remove_resized_image(url)
+
+def write_file_atomic(path, data):
+    # Skriv till en temporär fil och byt ut atomiskt, så att en avbruten skrivning inte lämnar en trasig cache
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
 
 def save_image_import_cache():
-    with open(CACHE_FILE, "w") as f:
-        json.dump(image_import_cache, f)
+    data = json.dumps(image_import_cache, separators=(",", ":"))
+    write_file_atomic(CACHE_FILE, data)
+    # Allt i loggen finns nu i CACHE_FILE
+    image_import_journal.truncate(0)
 
 def save_validation_cache():
-    with open(VALIDATION_CACHE_FILE, "w") as f:
-        json.dump(image_validation_cache, f)
+    with validation_cache_lock:
+        data = json.dumps(image_validation_cache, separators=(",", ":"))
+    write_file_atomic(VALIDATION_CACHE_FILE, data)
 
 import atexit
 @atexit.register
@@ -178,12 +328,142 @@ if not SHOPIFY_STORE_URL or not SHOPIFY_API_KEY:
     print("❌ Error: SHOPIFY_STORE_URL or SHOPIFY_API_KEY missing in .env file!")
     exit()
 
+# Shopifys REST-bucket: sov bara när den är fylld till mer än 80%
+SHOPIFY_THROTTLE_THRESHOLD = 0.8
+SHOPIFY_LEAK_RATE = 2  # Anrop per sekund som bucketen töms med (standardplan)
+SHOPIFY_MAX_BACKOFF = 32  # Max väntetid i sekunder vid upprepade 429
+
+class ShopifyBucket:
+    """
+    Client-side copy of Shopify's REST leaky bucket.
+    The fill level is read from X-Shopify-Shop-Api-Call-Limit ("used/max") after every response
+    and drained at the leak rate in between, so wait() only sleeps before a call when the
+    bucket is close to full. Shared by all threads using the Shopify session.
+    """
+    def __init__(self, leak_rate=SHOPIFY_LEAK_RATE, threshold=SHOPIFY_THROTTLE_THRESHOLD):
+        self.leak_rate = leak_rate
+        self.threshold = threshold
+        self.used = 0.0
+        self.capacity = 40
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _level(self, now):
+        return max(0.0, self.used - (now - self.updated_at) * self.leak_rate)
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            over = self._level(now) + 1 - self.threshold * self.capacity
+            if over > 0:
+                time.sleep(over / self.leak_rate)
+                now = time.monotonic()
+            # Räkna med anropet direkt så att parallella trådar inte alla ser en tom bucket
+            self.used = self._level(now) + 1
+            self.updated_at = now
+
+    def update(self, response, *args, **kwargs):
+        """Response hook: sync the level with what Shopify reports."""
+        call_limit = response.headers.get("X-Shopify-Shop-Api-Call-Limit")
+        if not call_limit:
+            return
+        try:
+            used, capacity = map(int, call_limit.split("/"))
+        except ValueError:
+            return
+        with self.lock:
+            self.used = used
+            self.capacity = capacity
+            self.updated_at = time.monotonic()
+
+shopify_bucket = ShopifyBucket()
+
+class ShopifySession(requests.Session):
+    """Session som väntar in Shopifys bucket före varje anrop"""
+    def request(self, *args, **kwargs):
+        shopify_bucket.wait()
+        return super().request(*args, **kwargs)
+
+class ShopifyRetry(Retry):
+    """
+    Retry som även försöker om POST vid 429. Shopify har då avvisat anropet utan att utföra det,
+    så det är säkert att skicka igen (Retry-After respekteras). Andra fel på POST försöks inte om,
+    eftersom anropet då kan ha skapat resursen.
+    Vid upprepade 429 fördubblas väntetiden från Retry-After, upp till SHOPIFY_MAX_BACKOFF sekunder.
+    """
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method == "POST" and status_code == 429:
+            return bool(self.total)
+        return super().is_retry(method, status_code, has_retry_after)
+
+    def parse_retry_after(self, retry_after):
+        # Shopify skickar decimaltal ("Retry-After: 2.0"), vilket urllib3 annars avvisar med ett undantag
+        try:
+            return max(float(retry_after), 0.0)
+        except ValueError:
+            return super().parse_retry_after(retry_after)
+
+    def sleep_for_retry(self, response=None):
+        retry_after = self.get_retry_after(response)
+        if retry_after:
+            attempt = max(len(self.history) - 1, 0)
+            time.sleep(min(retry_after * 2 ** attempt, SHOPIFY_MAX_BACKOFF))
+            return True
+        return False
+
+# En gemensam session för alla Shopify-anrop: återanvänder TCP/TLS-anslutningar (keep-alive)
+# och försöker igen vid 429/5xx (POST bara vid 429, se ShopifyRetry).
+shopify_session = ShopifySession()
+shopify_session.headers.update({
+    "Content-Type": "application/json",
+    "X-Shopify-Access-Token": SHOPIFY_API_KEY,
+})
+shopify_session.mount("https://", HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=32,
+    max_retries=ShopifyRetry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=frozenset(["GET", "PUT"]),
+        raise_on_status=False,
+    ),
+))
+shopify_session.hooks["response"].append(shopify_bucket.update)
+
+# Felsvar (t.ex. HTML-sidor vid 5xx) kortas av så att loggen inte fylls av hela svarskroppen
+ERROR_BODY_MAX_CHARS = 500
+
+def error_body(resp):
+    text = resp.text
+    if len(text) > ERROR_BODY_MAX_CHARS:
+        return f"{text[:ERROR_BODY_MAX_CHARS]}... ({len(text)} chars)"
+    return text
+
+@functools.lru_cache(maxsize=8192)
 def get_identifier_from_xml_url(url):
     parsed_url = urllib.parse.urlparse(url)
     basename = os.path.basename(parsed_url.path)
     identifier, _ = os.path.splitext(basename)
     return identifier.lower()
 
+@functools.lru_cache(maxsize=8192)
+def get_image_base(src):
+    """
+    Dedupe key for an image URL/src: basename without extension and hash/UUID suffixes.
+    Memoized since the same Shopify and feed URLs are compared on every update.
+    """
+    return get_base_without_hash(os.path.splitext(os.path.basename(src))[0])
+
+# Ett eller flera hash/UUID/nummer-suffix i slutet av filnamnet:
+# - UUID eller liknande: minst 32 tecken med minst 3 bindestreck (_e450759a-fd73-4409-a7f2-6410c82dee8e)
+# - Enkel hash: minst 16 alfanumeriska tecken utan bindestreck
+# - Löpnummer: _1, _2, ... (max två siffror)
+HASH_SUFFIX_RE = re.compile(r"(?:_(?:(?=(?:[^_-]*-){3})[^_]{32,}|[^\W_]{16,}|\d{1,2}))+$")
+
+# UUID som Shopify lägger till på uppladdade filnamn
+SHOPIFY_UUID_SUFFIX_RE = re.compile(r"_[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$")
+
 def get_base_without_hash(filename):
     """
     Remove hash/UUID suffixes from filenames.
@@ -192,200 +472,230 @@ def get_base_without_hash(filename):
     - image_4f68b42b-9d99-41c0-ba7b-ee8caa2acee7 -> image
     - image-123 -> image-123 (unchanged)
     """
-    # Keep removing suffix parts that look like hashes/UUIDs
-    while True:
-        parts = filename.rsplit("_", 1)
-        if len(parts) == 2:
-            suffix = parts[1]
-            # UUID pattern: 8-4-4-4-12 (e.g., 4f68b42b-9d99-41c0-ba7b-ee8caa2acee7)
-            # Hash pattern: long alphanumeric string (>= 32 chars typically)
-            # Simple numeric: _1, _2, etc (handled separately)
-
-            # Check for UUID pattern (has 4 dashes and is 36 chars)
-            if "-" in suffix and len(suffix) >= 32:
-                dash_count = suffix.count("-")
-                # UUID has exactly 4 dashes
-                if dash_count >= 3:  # UUID or similar hash
-                    filename = parts[0]
-                    continue
-
-            # Check for simple hash (long alphanumeric, no dashes, >= 16 chars)
-            elif len(suffix) >= 16 and suffix.isalnum():
-                filename = parts[0]
-                continue
-
-            # Check for simple numeric suffix _1, _2, etc
-            elif suffix.isdigit() and len(suffix) <= 2:
-                filename = parts[0]
-                continue
-
-        break
-
-    return filename.lower()
-
+    return HASH_SUFFIX_RE.sub("", filename).lower()
+
+# Normalize Swedish characters to match Shopify's ASCII conversion
+SWEDISH_CHARACTERS = {"å": "a", "ä": "a", "ö": "o"}
+SWEDISH_TRANSLATION = str.maketrans(SWEDISH_CHARACTERS)
+# Handles additionally turn dots into dashes
+HANDLE_TRANSLATION = str.maketrans({**SWEDISH_CHARACTERS, ".": "-"})
+HANDLE_NON_WORD_RE = re.compile(r"[^\w\s-]")
+# Whitespace and dashes in any mix collapse to a single dash
+HANDLE_SEPARATOR_RE = re.compile(r"[\s-]+")
+
+@functools.lru_cache(maxsize=None)
 def create_handle(title):
-    handle = title.lower()
-    # Normalize Swedish characters to match Shopify's ASCII conversion
-    handle = handle.replace("å", "a").replace("ä", "a").replace("ö", "o")
-    handle = re.sub(r"\.", "-", handle)
-    handle = re.sub(r"[^\w\s-]", "", handle)
-    handle = re.sub(r"\s+", "-", handle.strip())
-    handle = re.sub(r"-+", "-", handle)
-    return handle
+    handle = title.lower().translate(HANDLE_TRANSLATION)
+    handle = HANDLE_NON_WORD_RE.sub("", handle)
+    return HANDLE_SEPARATOR_RE.sub("-", handle.strip())
 
 SHOPIFY_API_ENDPOINT = f"https://{SHOPIFY_STORE_URL}/admin/api/2023-04/products.json"
+# Produktfälten som skriptet läser; övriga (body_html, options, metafält m.m.) hämtas inte
+SHOPIFY_PRODUCT_FIELDS = "id,handle,title,vendor,status,variants,images"
 SHOPIFY_SMART_COLLECTIONS_ENDPOINT = (
     f"https://{SHOPIFY_STORE_URL}/admin/api/2023-04/smart_collections.json"
 )
+# GraphQL körs mot 2024-04: inventorySetQuantities (som kan sätta "available") finns inte i 2023-04
+SHOPIFY_GRAPHQL_ENDPOINT = f"https://{SHOPIFY_STORE_URL}/admin/api/2024-04/graphql.json"
+
+# Max antal lagerändringar per inventorySetQuantities-anrop (Shopifys gräns)
+INVENTORY_BATCH_SIZE = 250
+# Antal produkter som arkiveras per GraphQL-anrop (en productUpdate per produkt, ~10 i kostnad styck)
+ARCHIVE_BATCH_SIZE = 10
+# Vänta in GraphQL-bucketen när färre kostnadspoäng än så här finns kvar
+GRAPHQL_MIN_AVAILABLE = 200
+INVENTORY_SET_MUTATION = """
+mutation inventorySetQuantities($input: InventorySetQuantitiesInput!) {
+  inventorySetQuantities(input: $input) {
+    userErrors { field message }
+  }
+}
+"""
+
+# Lagerplatsen hämtas en gång per körning (sätts av get_location_id)
+shopify_location_id = None
+
+# Unika tags från alla produkter i flödet, används för smart collections
+unique_tags = set()
+
+# Alla produkter i butiken per handle (sätts av prefetch_shopify_products, None = ej hämtad)
+shopify_products_by_handle = None
+
+# Tidpunkt då smart collections senast hämtades från Shopify (för cachens TTL)
+smart_collections_fetched_at = None
 
 xml_url = "https://www.chevalier.se/pricecomparison/hyperdrive.xml?IncludeHiddenProducts=false"
 
 try:
-    response = requests.get(xml_url)
+    response = requests.get(xml_url, stream=True)
     response.raise_for_status()
-    root = ET.fromstring(response.content)
     print("✅ Successfully fetched XML data.")
 except requests.exceptions.RequestException as e:
     print(f"❌ Error fetching XML: {e}")
     exit()
 
-def group_products(xml_root):
+def iter_xml_products(response, chunk_size=64 * 1024):
+    """
+    Stream products from the XML feed while it is being downloaded.
+    Each <product> is copied into a plain record (see product_record) and then
+    detached from the root, so neither the document tree nor the product elements
+    are held in memory.
+    """
+    parser = ET.XMLPullParser(events=("start", "end"))
+    root = None
+    depth = 0
+    for chunk in response.iter_content(chunk_size=chunk_size):
+        parser.feed(chunk)
+        for event, elem in parser.read_events():
+            if event == "start":
+                if root is None:
+                    root = elem
+                depth += 1
+                continue
+            depth -= 1
+            # Only direct children of the root are products (same as findall("product"))
+            if depth == 1 and elem.tag == "product":
+                yield product_record(elem)
+                root.clear()
+    parser.close()
+
+def group_products(products):
     groups = {}
-    for product in xml_root.findall("product"):
-        title_elem = product.find("name")
-        if title_elem is not None and title_elem.text:
-            title = title_elem.text.strip()
-            handle = create_handle(title)
+    for product in products:
+        title = product["fields"].get("name")
+        if title:
+            handle = create_handle(title.strip())
         else:
             handle = "no-title"
         groups.setdefault(handle, []).append(product)
     return groups
 
-def determine_product_categories(first):
-    allowed = {
-        "dam": "Dam",
-        "handskar": "Handskar",
-        "mössor och kepsar": "Mössor och Kepsar",
-        "accessoarer": "Accessoarer",
-        "herr": "Herr",
-        "jackor": "Jackor",
-        "t-shirts": "T-shirts",
-        "byxor": "Byxor",
-        "regnkläder": "Regnkläder",
-        "västar": "Västar",
-        "väskor": "Väskor",
-        "skor": "Skor",
-        "tröjor": "Tröjor",
-        "skjortor": "Skjortor",
-        "tweed": "Tweed",
-        "underställ": "Underställ",
-        "shorts": "Shorts",
-    }
-    extra_map = {
-        "huvudbonader": "Mössor och Kepsar",
-        "barnkläder": "Barn och Ungdom",
-        "kängor": "Skor",
+def get_child_texts(elem):
+    """
+    Read the text of every direct child in one pass: {tag: text}.
+    Like elem.find(tag), only the first child with a given tag is used (text may be None).
+    """
+    texts = {}
+    for child in elem:
+        if child.tag not in texts:
+            texts[child.tag] = child.text
+    return texts
+
+def product_record(elem):
+    """
+    Copy the parts of a <product> element that the import reads into plain data:
+    {"fields": {tag: text}, "images": [text, ...], "categories": [text, ...]}.
+    Much smaller than the element tree, which can be freed right after parsing.
+    """
+    return {
+        "fields": get_child_texts(elem),
+        "images": [img.text for img in elem.findall("images/image")],
+        "categories": [cat.text for cat in elem.findall("categories/category")],
     }
-    final_categories = []
-    for cat in first.findall("categories/category"):
-        text = cat.text
-        if text:
-            parts = [p.strip() for p in text.split(">")]
-            for part in parts:
-                lower_part = part.lower()
-                candidate = extra_map.get(lower_part) or allowed.get(lower_part)
-                if candidate and candidate not in final_categories:
-                    final_categories.append(candidate)
-    return final_categories
+
+# Kategorier från flödet (varje del i "A > B > C" matchas exakt, gemener) -> Shopify-kategori
+CATEGORY_MAP = {
+    "dam": "Dam",
+    "handskar": "Handskar",
+    "mössor och kepsar": "Mössor och Kepsar",
+    "accessoarer": "Accessoarer",
+    "herr": "Herr",
+    "jackor": "Jackor",
+    "t-shirts": "T-shirts",
+    "byxor": "Byxor",
+    "regnkläder": "Regnkläder",
+    "västar": "Västar",
+    "väskor": "Väskor",
+    "skor": "Skor",
+    "tröjor": "Tröjor",
+    "skjortor": "Skjortor",
+    "tweed": "Tweed",
+    "underställ": "Underställ",
+    "shorts": "Shorts",
+    # Flödeskategorier som heter något annat i butiken
+    "huvudbonader": "Mössor och Kepsar",
+    "barnkläder": "Barn och Ungdom",
+    "kängor": "Skor",
+}
+
+def determine_product_categories(category_texts):
+    # dict istället för lista: tar bort dubbletter utan linjär sökning men behåller ordningen
+    final_categories = {}
+    for text in category_texts:
+        for part in text.split(">"):
+            candidate = CATEGORY_MAP.get(part.strip().lower())
+            if candidate:
+                final_categories[candidate] = None
+    return list(final_categories)
 
 def extract_group_product_data(products):
     first = products[0]
-    title_elem = first.find("name")
-    title = title_elem.text.strip() if title_elem is not None else "No title"
+    first_fields = first["fields"]
+    title = first_fields["name"].strip() if "name" in first_fields else "No title"
 
-    desc_elem = first.find("description")
-    if desc_elem is not None and desc_elem.text:
-        description = desc_elem.text.strip()
+    description = first_fields.get("description")
+    if description:
+        description = description.strip()
     else:
-        html_desc_elem = first.find("html-description")
-        description = (
-            html_desc_elem.text.strip()
-            if html_desc_elem is not None and html_desc_elem.text
-            else ""
-        )
+        html_description = first_fields.get("html-description")
+        description = html_description.strip() if html_description else ""
 
     vendor = "Chevalier"
-    product_categories = determine_product_categories(first)
+    category_texts = [text for text in first["categories"] if text]
+    product_categories = determine_product_categories(category_texts)
 
     genders = set()
-    for cat in first.findall("categories/category"):
-        cat_text = cat.text
-        if cat_text:
-            lower_text = cat_text.lower()
-            if "herr" in lower_text or "män" in lower_text:
-                genders.add("Herr")
-            if "dam" in lower_text or "kvinnor" in lower_text:
-                genders.add("Dam")
+    for cat_text in category_texts:
+        lower_text = cat_text.lower()
+        if "herr" in lower_text or "män" in lower_text:
+            genders.add("Herr")
+        if "dam" in lower_text or "kvinnor" in lower_text:
+            genders.add("Dam")
     if not genders and "Accessoarer" not in product_categories:
         genders = {"Herr", "Dam"}
     gender_list = sorted(genders)
 
     variants = []
+    # dict istället för set: tar bort dubbletter men behåller ordningen från flödet
+    colors = {}
+    sizes = {}
     image_urls = set()
     variant_image_map = {}
 
     for prod in products:
-        sku_elem = prod.find("sku")
-        sku = sku_elem.text.strip() if sku_elem is not None and sku_elem.text else ""
+        fields = prod["fields"]
+        sku = (fields.get("sku") or "").strip()
         sku_lower = sku.lower()
 
-        color = (
-            prod.find("sub-name").text.strip()
-            if prod.find("sub-name") is not None and prod.find("sub-name").text
-            else ""
-        )
-        size = (
-            prod.find("SIZE").text.strip()
-            if prod.find("SIZE") is not None and prod.find("SIZE").text
-            else ""
-        )
+        color = (fields.get("sub-name") or "").strip()
+        size = (fields.get("SIZE") or "").strip()
 
         # Price handling: Use discounted price if available, otherwise regular price
-        discounted_price_elem = prod.find("discounted-price-with-vat")
-        regular_price_elem = prod.find("price-with-vat")
+        discounted_price = fields.get("discounted-price-with-vat")
+        regular_price = fields.get("price-with-vat")
 
-        if discounted_price_elem is not None and discounted_price_elem.text:
+        if discounted_price:
             # Product is on sale - use discounted price and show original as compare_at_price
-            price = discounted_price_elem.text.replace(",", ".").strip()
+            price = discounted_price.replace(",", ".").strip()
             compare_at_price = (
-                regular_price_elem.text.replace(",", ".").strip()
-                if regular_price_elem is not None and regular_price_elem.text
-                else None
+                regular_price.replace(",", ".").strip() if regular_price else None
             )
-        elif regular_price_elem is not None and regular_price_elem.text:
+        elif regular_price:
             # Regular price, no discount
-            price = regular_price_elem.text.replace(",", ".").strip()
+            price = regular_price.replace(",", ".").strip()
             compare_at_price = None
         else:
             price = "0.00"
             compare_at_price = None
 
+        stock_level = fields.get("stock-level") or ""
         variant = {
             "sku": sku,
             "option1": color,
             "option2": size,
             "price": price,
-            "barcode": (
-                prod.find("gtin-ean").text.strip()
-                if prod.find("gtin-ean") is not None and prod.find("gtin-ean").text
-                else ""
-            ),
-            "inventory_quantity": (
-                int(prod.find("stock-level").text.strip())
-                if prod.find("stock-level") is not None
-                and prod.find("stock-level").text.isdigit()
-                else 0
-            ),
+            "barcode": (fields.get("gtin-ean") or "").strip(),
+            "inventory_quantity": int(stock_level) if stock_level.isdigit() else 0,
             "inventory_management": "shopify",
             "inventory_policy": "deny",
         }
@@ -395,37 +705,41 @@ def extract_group_product_data(products):
             variant["compare_at_price"] = compare_at_price
 
         variants.append(variant)
+        colors[color] = None
+        sizes[size] = None
 
-        images = prod.findall("images/image")
+        images = prod["images"]
         if images:
-            first_image_url = images[0].text.strip() if images[0].text else None
+            first_image_url = images[0].strip() if images[0] else None
             if first_image_url:
                 variant_image_map[sku_lower] = first_image_url
                 color_key = color.lower()
                 if color_key and color_key not in variant_image_map:
                     variant_image_map[color_key] = first_image_url
-            for img in images:
-                url = img.text.strip() if img.text else None
+            for image_text in images:
+                url = image_text.strip() if image_text else None
                 if url and not is_image_imported(url):
                     image_urls.add(url)
 
-    colors = list({v["option1"] for v in variants})
-    sizes = list({v["option2"] for v in variants})
     options = [
-        {"name": "Color", "position": 1, "values": colors},
-        {"name": "Size", "position": 2, "values": sizes},
+        {"name": "Color", "position": 1, "values": list(colors)},
+        {"name": "Size", "position": 2, "values": list(sizes)},
     ]
 
     handle = create_handle(title)
     primary_tag = f"handle:{handle}"
     all_tags = [primary_tag] + product_categories + sorted(gender_list)
     tags = ", ".join(all_tags)
+    # Samla unika tags (för smart collections) direkt istället för att parsa tags-strängen igen
+    unique_tags.update(t for t in all_tags if not t.startswith(("group_sku:", "handle:")))
 
-    # Förbered bilder (kan vara resizade)
+    # Förbered bilder (kan vara resizade) - hämtas parallellt, resultaten i samma ordning som URL:erna
     images = []
     original_urls = []  # Spara original-URLer för att märka som importerade
-    for url in image_urls:
-        image_data = prepare_image_for_shopify(url)
+    image_urls = list(image_urls)
+    with ThreadPoolExecutor(max_workers=IMAGE_WORKERS) as executor:
+        prepared_images = list(executor.map(prepare_image_for_shopify, image_urls))
+    for url, image_data in zip(image_urls, prepared_images):
         if image_data:
             images.append(image_data)
             original_urls.append(url)  # Spara original-URL
@@ -445,43 +759,88 @@ def extract_group_product_data(products):
     }
     return product_data
 
+def iter_product_data(groups, workers=EXTRACT_WORKERS):
+    """
+    Prepare product payloads in background threads while earlier products are sent to Shopify.
+    Image download/validation for upcoming products overlaps with the (rate limited) Shopify
+    calls, which are still made one at a time by the caller. At most `workers` products are
+    prepared ahead to keep memory bounded, and payloads are yielded in feed order.
+    `groups` is a deque that is consumed as products are submitted, so each group's XML
+    elements can be freed as soon as its payload has been built and uploaded.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        while groups:
+            pending.append(executor.submit(extract_group_product_data, groups.popleft()))
+            if len(pending) > workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def prefetch_shopify_products():
+    """
+    Fetch all products in the store (all vendors, like the handle lookup) once,
+    so create-vs-update can be decided locally instead of one GET per product.
+    Returns False if any page fails; lookups then fall back to per-handle GETs.
+    """
+    global shopify_products_by_handle
+    products_by_handle = {}
+    url = (
+        f"https://{SHOPIFY_STORE_URL}/admin/api/2023-04/products.json"
+        f"?limit=250&fields={SHOPIFY_PRODUCT_FIELDS}"
+    )
+    while url:
+        resp = shopify_session.get(url)
+        if resp.status_code != 200:
+            print(f"❌ Failed to prefetch products from Shopify: {resp.status_code}")
+            print(error_body(resp))
+            return False
+        for product in resp.json().get("products", []):
+            if product.get("handle"):
+                products_by_handle[product["handle"]] = product
+        url = resp.links.get("next", {}).get("url")
+
+    shopify_products_by_handle = products_by_handle
+    print(f"   Found {len(products_by_handle)} existing products on Shopify")
+    return True
+
 def find_product_by_handle(product_title):
-    headers = {
-        "Content-Type": "application/json",
-        "X-Shopify-Access-Token": SHOPIFY_API_KEY,
-    }
+    """
+    Return the existing Shopify product (dict with id, handle, variants, images) or None.
+    """
     handle = create_handle(product_title)
+    if shopify_products_by_handle is not None:
+        return shopify_products_by_handle.get(handle)
     search_url = (
-        f"https://{SHOPIFY_STORE_URL}/admin/api/2023-04/products.json?handle={handle}"
+        f"https://{SHOPIFY_STORE_URL}/admin/api/2023-04/products.json"
+        f"?handle={handle}&fields={SHOPIFY_PRODUCT_FIELDS}"
     )
-    response = requests.get(search_url, headers=headers)
+    response = shopify_session.get(search_url)
     if response.status_code == 200:
         data = response.json()
         products = data.get("products", [])
         if products:
-            return products[0]["id"]
+            return products[0]
     return None
 
-def update_product(product_id, product_data):
-    headers = {
-        "Content-Type": "application/json",
-        "X-Shopify-Access-Token": SHOPIFY_API_KEY,
-    }
+def update_product(product_id, product_data, current_product=None):
     product_url = (
         f"https://{SHOPIFY_STORE_URL}/admin/api/2023-04/products/{product_id}.json"
     )
-    current_resp = requests.get(product_url, headers=headers)
-    if current_resp.status_code != 200:
-        print(f"❌ Failed to fetch current product {product_id}: {current_resp.text}")
-        return None
-    current_product = current_resp.json().get("product", {})
+    if current_product is None:
+        current_resp = shopify_session.get(f"{product_url}?fields=id,variants,images")
+        if current_resp.status_code != 200:
+            print(f"❌ Failed to fetch current product {product_id}: {error_body(current_resp)}")
+            return None
+        current_product = current_resp.json().get("product", {})
     current_variants = current_product.get("variants", [])
     current_map = {
-        variant.get("sku", "").strip().lower(): variant for variant in current_variants
+        (variant.get("sku") or "").strip().lower(): variant for variant in current_variants
     }
 
     for new_var in product_data.get("variants", []):
-        new_sku = new_var.get("sku", "").strip().lower()
+        # SKU:n från flödet är redan strippad i extract_group_product_data
+        new_sku = new_var["sku"].lower()
         if new_sku in current_map:
             current_map[new_sku]["price"] = new_var["price"]
             # Handle compare_at_price (for discounted products)
@@ -499,27 +858,25 @@ def update_product(product_id, product_data):
             current_variants.append(new_var)
 
     current_images = current_product.get("images", [])
+    # Basnamn för befintliga bilder beräknas en gång istället för per ny bild
+    existing_bases = {
+        get_image_base(existing_image.get("src", "") or "")
+        for existing_image in current_images
+    }
     for image in product_data.get("images", []):
         # Kan vara antingen {"src": url} eller {"attachment": ..., "filename": ...}
         if image.get("src"):
             # URL-baserad bild
             src = image.get("src")
-            base = get_base_without_hash(os.path.splitext(os.path.basename(src))[0])
-            duplicate_found = any(
-                base == get_base_without_hash(os.path.splitext(os.path.basename(existing_image.get("src", "") or ""))[0])
-                for existing_image in current_images
-            )
-            if not duplicate_found:
+            base = get_image_base(src)
+            if base not in existing_bases:
                 current_images.append({"src": src})
+                existing_bases.add(base)
         elif image.get("attachment"):
-            # Resizad bild som attachment
+            # Resizad bild som attachment (har ingen src, så den läggs inte till i existing_bases)
             filename = image.get("filename", "image.jpg")
             base = get_base_without_hash(os.path.splitext(filename)[0])
-            duplicate_found = any(
-                base == get_base_without_hash(os.path.splitext(os.path.basename(existing_image.get("src", "") or ""))[0])
-                for existing_image in current_images
-            )
-            if not duplicate_found:
+            if base not in existing_bases:
                 current_images.append(image)
 
     updated_data = {
@@ -528,101 +885,147 @@ def update_product(product_id, product_data):
         "images": current_images,
     }
     payload = {"product": updated_data}
-    update_resp = requests.put(product_url, json=payload, headers=headers)
+    update_resp = shopify_session.put(product_url, json=payload)
     if update_resp.status_code == 200:
         print(f"✅ Successfully updated product: {product_data['title']} (ID: {product_id}) with updated price/inventory, variants and images.")
-        return product_id
+        # Svaret innehåller hela den uppdaterade produkten (varianter + bilder med id),
+        # så lager- och bildkopplingen behöver inte hämta den igen
+        return update_resp.json().get("product", {"id": product_id})
     else:
         print(
             f"❌ Failed to update product: {product_data['title']} (ID: {product_id})"
         )
-        print(update_resp.text)
+        print(error_body(update_resp))
         return None
 
-def assign_variant_images(product_id, variant_image_map):
-    headers = {
-        "Content-Type": "application/json",
-        "X-Shopify-Access-Token": SHOPIFY_API_KEY,
-    }
+def assign_variant_images(product_id, variant_image_map, product=None):
     product_url = (
         f"https://{SHOPIFY_STORE_URL}/admin/api/2023-04/products/{product_id}.json"
     )
-    product_resp = requests.get(product_url, headers=headers)
-    if product_resp.status_code != 200:
-        print(
-            f"❌ Failed to fetch product {product_id} for variant image assignment: {product_resp.text}"
-        )
-        return
-    product_data = product_resp.json().get("product", {})
+    if product is None:
+        product_resp = shopify_session.get(f"{product_url}?fields=id,variants,images")
+        if product_resp.status_code != 200:
+            print(
+                f"❌ Failed to fetch product {product_id} for variant image assignment: {error_body(product_resp)}"
+            )
+            return
+        product = product_resp.json().get("product", {})
+    product_data = product
 
     image_mapping = {}
+    # Samma bilder utan Shopifys UUID-suffix (a_1_e450759a-... -> a_1), för exakt uppslag
+    image_mapping_without_uuid = {}
     for img in product_data.get("images", []):
         src = img.get("src", "")
         base = os.path.splitext(os.path.basename(src))[0].lower()
         image_mapping[base] = img.get("id")
+        image_mapping_without_uuid.setdefault(SHOPIFY_UUID_SUFFIX_RE.sub("", base), img.get("id"))
 
+    found_image_ids = {}
     updated_variants = []
     for variant in product_data.get("variants", []):
-        sku = variant.get("sku", "").strip().lower()
-        color_in_variant = variant.get("option1", "").strip().lower()
+        sku = (variant.get("sku") or "").strip().lower()
+        color_in_variant = (variant.get("option1") or "").strip().lower()
         assigned_image_url = variant_image_map.get(sku) or variant_image_map.get(
             color_in_variant
         )
         if assigned_image_url:
-            feed_identifier = os.path.splitext(
-                os.path.basename(urllib.parse.urlparse(assigned_image_url).path)
-            )[0].lower()
-            found_image_id = None
-            for shopify_identifier, shopify_image_id in image_mapping.items():
-                if feed_identifier in shopify_identifier:
-                    found_image_id = shopify_image_id
-                    break
+            feed_identifier = get_identifier_from_xml_url(assigned_image_url)
+            if feed_identifier not in found_image_ids:
+                # Exakt träff först (med eller utan Shopifys UUID-suffix), annars delsträng
+                found_image_id = image_mapping.get(feed_identifier)
+                if found_image_id is None:
+                    found_image_id = image_mapping_without_uuid.get(feed_identifier)
+                if found_image_id is None:
+                    for shopify_identifier, shopify_image_id in image_mapping.items():
+                        if feed_identifier in shopify_identifier:
+                            found_image_id = shopify_image_id
+                            break
+                found_image_ids[feed_identifier] = found_image_id
+            found_image_id = found_image_ids[feed_identifier]
             if found_image_id:
                 variant["image_id"] = found_image_id
         updated_variants.append(variant)
 
     update_payload = {"product": {"id": product_id, "variants": updated_variants}}
-    update_resp = requests.put(product_url, json=update_payload, headers=headers)
+    update_resp = shopify_session.put(product_url, json=update_payload)
     if update_resp.status_code != 200:
         print(
-            f"❌ Failed to update variant image assignments for product {product_id}: {update_resp.text}"
+            f"❌ Failed to update variant image assignments for product {product_id}: {error_body(update_resp)}"
         )
 
-def update_inventory_levels(product_id, product_data):
-    headers = {
-        "Content-Type": "application/json",
-        "X-Shopify-Access-Token": SHOPIFY_API_KEY,
-    }
+def get_location_id():
+    global shopify_location_id
+    if shopify_location_id:
+        return shopify_location_id
     locations_url = f"https://{SHOPIFY_STORE_URL}/admin/api/2023-04/locations.json"
-    loc_resp = requests.get(locations_url, headers=headers)
+    loc_resp = shopify_session.get(locations_url)
     if loc_resp.status_code != 200:
         print(f"❌ CRITICAL: Failed to fetch locations for inventory update!")
         print(f"   Status code: {loc_resp.status_code}")
-        print(f"   Error: {loc_resp.text}")
+        print(f"   Error: {error_body(loc_resp)}")
         print(f"   ⚠️  Inventory levels will NOT be updated! Check API permissions (read_locations scope required)")
-        return
+        return None
     locations = loc_resp.json().get("locations", [])
     if not locations:
         print("❌ CRITICAL: No locations found! Inventory levels will NOT be updated!")
-        return
-    location_id = locations[0]["id"]
-    print(f"📍 Using location ID: {location_id} for inventory updates")
+        return None
+    shopify_location_id = locations[0]["id"]
+    print(f"📍 Using location ID: {shopify_location_id} for inventory updates")
+    return shopify_location_id
 
-    product_url = f"https://{SHOPIFY_STORE_URL}/admin/api/2023-04/products/{product_id}.json"
-    prod_resp = requests.get(product_url, headers=headers)
-    if prod_resp.status_code != 200:
-        print(f"❌ Failed to fetch product {product_id} for inventory update: {prod_resp.text}")
+def shopify_graphql(query, variables=None):
+    """
+    Run a GraphQL Admin API request. Returns the "data" dict, or None if the request
+    failed (HTTP error or top-level GraphQL errors such as THROTTLED).
+    """
+    resp = shopify_session.post(
+        SHOPIFY_GRAPHQL_ENDPOINT, json={"query": query, "variables": variables or {}}
+    )
+    if resp.status_code != 200:
+        print(f"❌ GraphQL request failed ({resp.status_code}): {error_body(resp)}")
+        return None
+    body = resp.json()
+
+    # GraphQL har en egen bucket (kostnadspoäng), rapporterad i extensions.cost.throttleStatus
+    throttle_status = body.get("extensions", {}).get("cost", {}).get("throttleStatus")
+    if throttle_status:
+        available = throttle_status.get("currentlyAvailable", 0)
+        restore_rate = throttle_status.get("restoreRate") or 50
+        if available < GRAPHQL_MIN_AVAILABLE:
+            time.sleep((GRAPHQL_MIN_AVAILABLE - available) / restore_rate)
+
+    if body.get("errors"):
+        print(f"❌ GraphQL errors: {body['errors']}")
+        return None
+    return body.get("data") or {}
+
+def update_inventory_levels(product_id, product_data, product=None):
+    location_id = get_location_id()
+    if not location_id:
         return
-    product = prod_resp.json().get("product", {})
+
+    if product is None:
+        product_url = (
+            f"https://{SHOPIFY_STORE_URL}/admin/api/2023-04/products/{product_id}.json?fields=variants"
+        )
+        prod_resp = shopify_session.get(product_url)
+        if prod_resp.status_code != 200:
+            print(f"❌ Failed to fetch product {product_id} for inventory update: {error_body(prod_resp)}")
+            return
+        product = prod_resp.json().get("product", {})
     shopify_variants = product.get("variants", [])
 
     sku_to_inventory_item_id = {}
     for variant in shopify_variants:
-        sku = variant.get("sku", "").lower()
+        sku = (variant.get("sku") or "").lower()
         inventory_item_id = variant.get("inventory_item_id")
         if sku and inventory_item_id:
             sku_to_inventory_item_id[sku] = inventory_item_id
 
+    # Samla alla lagernivåer för produkten och skicka dem i en GraphQL-mutation
+    # istället för ett inventory_levels/set-anrop per SKU
+    set_quantities = []
     for variant in product_data.get("variants", []):
         sku = variant.get("sku", "").lower()
         desired_qty = variant.get("inventory_quantity", 0)
@@ -630,47 +1033,63 @@ def update_inventory_levels(product_id, product_data):
         if not inventory_item_id:
             print(f"❌ No inventory_item_id found for SKU: {sku}")
             continue
-        update_url = f"https://{SHOPIFY_STORE_URL}/admin/api/2023-04/inventory_levels/set.json"
-        payload = {
-            "location_id": location_id,
-            "inventory_item_id": inventory_item_id,
-            "available": desired_qty
-        }
-        inv_resp = requests.post(update_url, json=payload, headers=headers)
-        if inv_resp.status_code == 200:
-            print(f"✅ Inventory for SKU {sku} updated to {desired_qty}")
+        set_quantities.append({
+            "inventoryItemId": f"gid://shopify/InventoryItem/{inventory_item_id}",
+            "locationId": f"gid://shopify/Location/{location_id}",
+            "quantity": desired_qty,
+        })
+
+    for start in range(0, len(set_quantities), INVENTORY_BATCH_SIZE):
+        batch = set_quantities[start:start + INVENTORY_BATCH_SIZE]
+        data = shopify_graphql(
+            INVENTORY_SET_MUTATION,
+            {"input": {
+                # Sätt tillgängligt antal (som inventory_levels/set.json gjorde), inte on hand -
+                # annars dras redan reserverade/beställda enheter av från flödets antal
+                "name": "available",
+                "reason": "correction",
+                "ignoreCompareQuantity": True,
+                "quantities": batch,
+            }},
+        )
+        if data is None:
+            print(f"❌ Failed to update inventory for product {product_id}")
+            continue
+        user_errors = data.get("inventorySetQuantities", {}).get("userErrors", [])
+        if user_errors:
+            print(f"❌ Failed to update inventory for product {product_id}: {user_errors}")
         else:
-            print(f"❌ Failed to update inventory for SKU {sku}: {inv_resp.text}")
-        time.sleep(0.6)
+            print(f"✅ Inventory updated for {len(batch)} SKU(s)")
 
 def send_to_shopify(product_data):
-    headers = {
-        "Content-Type": "application/json",
-        "X-Shopify-Access-Token": SHOPIFY_API_KEY,
-    }
-    existing_id = find_product_by_handle(product_data["title"])
-    if existing_id:
-        prod_id = update_product(existing_id, product_data)
+    existing = find_product_by_handle(product_data["title"])
+    if existing:
+        product = update_product(existing["id"], product_data, existing)
     else:
-        response = requests.post(
-            SHOPIFY_API_ENDPOINT, json={"product": product_data}, headers=headers
+        response = shopify_session.post(
+            SHOPIFY_API_ENDPOINT, json={"product": product_data}
         )
         if response.status_code == 201:
-            prod_id = response.json()["product"]["id"]
-            print(f"✅ Successfully added product: {product_data['title']} (ID: {prod_id})")
+            product = response.json()["product"]
+            print(f"✅ Successfully added product: {product_data['title']} (ID: {product['id']})")
         else:
             print(f"❌ Failed to add product: {product_data['title']}")
-            print(f"Error: {response.text}")
-            prod_id = None
+            print(f"Error: {error_body(response)}")
+            product = None
 
+    prod_id = product["id"] if product else None
     if prod_id:
+        # Håll den förhämtade produktlistan aktuell om samma handle dyker upp igen
+        if shopify_products_by_handle is not None and product.get("handle"):
+            shopify_products_by_handle[product["handle"]] = product
+
         # Märk bilder som importerade (använd original-URLer)
         for url in product_data.get("original_image_urls", []):
             mark_image_imported(url)
 
-        update_inventory_levels(prod_id, product_data)
+        update_inventory_levels(prod_id, product_data, product)
         if "variant_image_map" in product_data:
-            assign_variant_images(prod_id, product_data["variant_image_map"])
+            assign_variant_images(prod_id, product_data["variant_image_map"], product)
         # Ensure product is published globally (visible on all sales channels)
         ensure_global_publication(prod_id)
     return prod_id
@@ -680,11 +1099,6 @@ def ensure_global_publication(product_id):
     Ensure product is published with global scope, making it visible on all sales channels
     including Online Store, Google & YouTube, Facebook & Instagram, etc.
     """
-    headers = {
-        "Content-Type": "application/json",
-        "X-Shopify-Access-Token": SHOPIFY_API_KEY,
-    }
-
     # Update product to have global published_scope
     url = f"https://{SHOPIFY_STORE_URL}/admin/api/2023-04/products/{product_id}.json"
     payload = {
@@ -695,33 +1109,40 @@ def ensure_global_publication(product_id):
         }
     }
 
-    resp = requests.put(url, json=payload, headers=headers)
+    resp = shopify_session.put(url, json=payload)
 
     if resp.status_code == 200:
         print(f"   📢 Product published globally (visible on all sales channels)")
     else:
         print(f"   ⚠️  Could not set global publication: {resp.status_code}")
         if resp.text:
-            print(f"      Error: {resp.text}")
+            print(f"      Error: {error_body(resp)}")
 
 def get_all_chevalier_products_from_shopify():
     """
     Fetch all Chevalier products from Shopify.
     Returns a dict with handle as key and product data as value.
     """
-    headers = {
-        "Content-Type": "application/json",
-        "X-Shopify-Access-Token": SHOPIFY_API_KEY,
-    }
+    if shopify_products_by_handle is not None:
+        # Återanvänd produkterna som hämtades i början av körningen (hålls aktuella under importen)
+        return {
+            handle: {
+                "id": product.get("id"),
+                "title": product.get("title"),
+                "status": product.get("status")
+            }
+            for handle, product in shopify_products_by_handle.items()
+            if product.get("vendor") == "Chevalier"
+        }
 
     all_products = {}
-    url = f"https://{SHOPIFY_STORE_URL}/admin/api/2023-04/products.json?vendor=Chevalier&limit=250"
+    url = f"https://{SHOPIFY_STORE_URL}/admin/api/2023-04/products.json?vendor=Chevalier&limit=250&fields=id,handle,title,status"
 
     while url:
-        resp = requests.get(url, headers=headers)
+        resp = shopify_session.get(url)
         if resp.status_code != 200:
             print(f"❌ Failed to fetch Chevalier products from Shopify: {resp.status_code}")
-            print(resp.text)
+            print(error_body(resp))
             break
 
         data = resp.json()
@@ -747,10 +1168,16 @@ def get_all_chevalier_products_from_shopify():
                     url = part.split(";")[0].strip("<> ")
                     break
 
-        time.sleep(0.5)  # Rate limiting
-
     return all_products
 
+def build_archive_mutation(count):
+    """GraphQL document with `count` aliased productUpdate mutations (p0..pN), one variable each."""
+    params = ", ".join(f"$p{i}: ProductInput!" for i in range(count))
+    fields = "\n".join(
+        f"  p{i}: productUpdate(input: $p{i}) {{ userErrors {{ field message }} }}" for i in range(count)
+    )
+    return f"mutation archiveProducts({params}) {{\n{fields}\n}}"
+
 def archive_products_not_in_feed(feed_handles, min_feed_size=200):
     """
     Archive (set to draft) Chevalier products that exist on Shopify but not in XML feed.
@@ -773,13 +1200,13 @@ def archive_products_not_in_feed(feed_handles, min_feed_size=200):
 
     # Normalize both sets of handles for comparison (Shopify may normalize Swedish characters)
     # Create normalized version of feed_handles
-    feed_handles_normalized = {h.replace("å", "a").replace("ä", "a").replace("ö", "o") for h in feed_handles}
+    feed_handles_normalized = {h.translate(SWEDISH_TRANSLATION) for h in feed_handles}
 
     # Find products on Shopify but not in feed
     to_archive = []
     for handle, product_data in shopify_products.items():
         # Normalize Shopify handle for comparison
-        handle_normalized = handle.replace("å", "a").replace("ä", "a").replace("ö", "o")
+        handle_normalized = handle.translate(SWEDISH_TRANSLATION)
         if handle_normalized not in feed_handles_normalized and product_data["status"] == "active":
             to_archive.append((handle, product_data))
 
@@ -789,132 +1216,158 @@ def archive_products_not_in_feed(feed_handles, min_feed_size=200):
 
     print(f"\n📦 Found {len(to_archive)} products to archive:")
 
-    headers = {
-        "Content-Type": "application/json",
-        "X-Shopify-Access-Token": SHOPIFY_API_KEY,
-    }
-
+    # Arkivera i batchar: flera alias-mutationer (productUpdate) per GraphQL-anrop istället för en PUT per produkt
     archived_count = 0
-    for handle, product_data in to_archive:
-        product_id = product_data["id"]
-        title = product_data["title"]
+    for start in range(0, len(to_archive), ARCHIVE_BATCH_SIZE):
+        batch = to_archive[start:start + ARCHIVE_BATCH_SIZE]
+        variables = {}
+        for i, (handle, product_data) in enumerate(batch):
+            print(f"   📥 Archiving: {product_data['title']} (handle: {handle})")
+            variables[f"p{i}"] = {
+                "id": f"gid://shopify/Product/{product_data['id']}",
+                "status": "DRAFT",
+            }
 
-        print(f"   📥 Archiving: {title} (handle: {handle})")
+        data = shopify_graphql(build_archive_mutation(len(batch)), variables)
+        for i, (handle, product_data) in enumerate(batch):
+            if data is None:
+                print(f"      ❌ Failed to archive: {product_data['title']} (handle: {handle})")
+                continue
+            user_errors = (data.get(f"p{i}") or {}).get("userErrors", [])
+            if user_errors:
+                print(f"      ❌ Failed to archive: {product_data['title']} (handle: {handle})")
+                print(f"         Error: {user_errors}")
+            else:
+                print(f"      ✅ Archived successfully: {product_data['title']}")
+                archived_count += 1
 
-        url = f"https://{SHOPIFY_STORE_URL}/admin/api/2023-04/products/{product_id}.json"
-        payload = {
-            "product": {
-                "id": product_id,
-                "status": "draft"
-            }
-        }
+    print(f"\n✅ Auto-cleanup complete: {archived_count}/{len(to_archive)} products archived")
 
-        resp = requests.put(url, json=payload, headers=headers)
-        if resp.status_code == 200:
-            print(f"      ✅ Archived successfully")
-            archived_count += 1
-        else:
-            print(f"      ❌ Failed to archive: {resp.status_code}")
-            if resp.text:
-                print(f"         Error: {resp.text}")
+def get_smart_collections_cache_key():
+    return f"{SMART_COLLECTIONS_CACHE_VERSION}:{SHOPIFY_STORE_URL}"
 
-        time.sleep(0.6)  # Rate limiting
+def load_smart_collections_cache():
+    """Returnerar cachade smart collections om filen hör till samma butik och inte är för gammal."""
+    global smart_collections_fetched_at
+    if not os.path.exists(SMART_COLLECTIONS_CACHE_FILE):
+        return None
+    try:
+        with open(SMART_COLLECTIONS_CACHE_FILE, "r") as f:
+            cached = json.load(f)
+    except ValueError:
+        return None
+    if cached.get("key") != get_smart_collections_cache_key():
+        return None
+    if time.time() - cached.get("fetched_at", 0) > SMART_COLLECTIONS_CACHE_TTL:
+        return None
+    smart_collections_fetched_at = cached["fetched_at"]
+    return cached["collections"]
 
-    print(f"\n✅ Auto-cleanup complete: {archived_count}/{len(to_archive)} products archived")
+def save_smart_collections_cache(collections):
+    write_file_atomic(SMART_COLLECTIONS_CACHE_FILE, json.dumps({
+        "key": get_smart_collections_cache_key(),
+        "fetched_at": smart_collections_fetched_at,
+        "collections": collections,
+    }))
 
 def get_existing_smart_collections():
-    headers = {
-        "Content-Type": "application/json",
-        "X-Shopify-Access-Token": SHOPIFY_API_KEY,
-    }
-    response = requests.get(SHOPIFY_SMART_COLLECTIONS_ENDPOINT, headers=headers)
-    if response.status_code == 200:
-        data = response.json()
-        return {sc["title"]: sc["id"] for sc in data.get("smart_collections", [])}
-    else:
-        print("❌ Failed to fetch smart collections")
-        print(response.text)
-        return {}
+    global smart_collections_fetched_at
+    cached = load_smart_collections_cache()
+    if cached is not None:
+        print(f"📂 Using cached smart collections ({len(cached)} collections)")
+        return cached
+
+    # Shopify ger 50 per sida som standard; följ Link-headern så att alla collections kommer med
+    collections = {}
+    url = f"{SHOPIFY_SMART_COLLECTIONS_ENDPOINT}?limit=250&fields=id,title"
+    while url:
+        response = shopify_session.get(url)
+        if response.status_code != 200:
+            print("❌ Failed to fetch smart collections")
+            print(error_body(response))
+            return {}
+        for sc in response.json().get("smart_collections", []):
+            collections[sc["title"]] = sc["id"]
+        url = response.links.get("next", {}).get("url")
+
+    smart_collections_fetched_at = time.time()
+    save_smart_collections_cache(collections)
+    return collections
 
 def create_smart_collection(title):
-    headers = {
-        "Content-Type": "application/json",
-        "X-Shopify-Access-Token": SHOPIFY_API_KEY,
-    }
     payload = {
         "smart_collection": {
             "title": title,
             "rules": [{"column": "tag", "relation": "equals", "condition": title}],
         }
     }
-    response = requests.post(
-        SHOPIFY_SMART_COLLECTIONS_ENDPOINT, json=payload, headers=headers
-    )
+    response = shopify_session.post(SHOPIFY_SMART_COLLECTIONS_ENDPOINT, json=payload)
     if response.status_code == 201:
         sc = response.json()["smart_collection"]
         print(f"✅ Created smart collection: {title} (ID: {sc['id']})")
         return sc["id"]
     else:
         print(f"❌ Failed to create smart collection: {title}")
-        print(response.text)
+        print(error_body(response))
         return None
 
 # ----- HUVUDFLÖDE -----
 start_time = datetime.now()
 print(f"🕐 Script started at: {start_time.strftime('%Y-%m-%d %H:%M:%S')}")
 
-grouped_products = group_products(root)
-grouped_products_list = list(grouped_products.values())
-print(f"Found {len(grouped_products_list)} product groups from XML.")
+try:
+    grouped_products = group_products(iter_xml_products(response))
+except requests.exceptions.RequestException as e:
+    print(f"❌ Error fetching XML: {e}")
+    exit()
+# Grupperna plockas ut ur kön när de förbereds, så att flödet inte ligger kvar i minnet under uppladdningen
+grouped_products_list = deque(grouped_products.values())
+del grouped_products
+product_count = len(grouped_products_list)
+print(f"Found {product_count} product groups from XML.")
 
 imported_product_ids = []
-unique_tags = set()
 
-# Collect ALL handles from feed for cleanup
-# Extract handles directly without building full payload to avoid image processing
+# Collect ALL handles from feed for cleanup (filled in the import loop, from the payloads' handles)
 feed_handles = set()
-print("🔍 Collecting product handles from feed for cleanup...")
-for group in grouped_products_list:
-    if group:
-        first = group[0]
-        title_elem = first.find("name")
-        if title_elem is not None and title_elem.text:
-            title = title_elem.text.strip()
-            handle = create_handle(title)
-            feed_handles.add(handle)
-print(f"   Found {len(feed_handles)} unique products in feed")
-
-for i, group in enumerate(grouped_products_list, 1):
-    print(f"\n📦 Processing product {i}/{len(grouped_products_list)}...")
-    product_data = extract_group_product_data(group)
-
-    # Samla unika tags medan vi processar
-    tags_str = product_data.get("tags", "")
-    for tag in tags_str.split(","):
-        t = tag.strip()
-        if t and not t.startswith("group_sku:") and not t.startswith("handle:"):
-            unique_tags.add(t)
+
+print("🔍 Fetching existing products from Shopify...")
+prefetch_shopify_products()
+
+for i, product_data in enumerate(iter_product_data(grouped_products_list), 1):
+    print(f"\n📦 Processing product {i}/{product_count}...")
+    feed_handles.add(product_data["handle"])
 
     prod_id = send_to_shopify(product_data)
     if prod_id:
         imported_product_ids.append(prod_id)
-    time.sleep(1.0)  # För att undvika rate limits
+    if i % CACHE_CHECKPOINT_INTERVAL == 0:
+        save_image_import_cache()
 
 save_image_import_cache()  # Sparar cache ännu en gång efter loopen
 print("Unika taggar (för smart collections):", unique_tags)
 
 existing_collections = get_existing_smart_collections()
+missing_collections = []
 for tag in unique_tags:
     if tag not in existing_collections:
-        created_id = create_smart_collection(tag)
-        if created_id:
-            existing_collections[tag] = created_id
+        missing_collections.append(tag)
     else:
         print(
             f"Smart collection '{tag}' already exists (ID: {existing_collections[tag]})"
         )
+# Skapa saknade collections parallellt via den gemensamma sessionen
+with ThreadPoolExecutor(max_workers=SMART_COLLECTION_WORKERS) as executor:
+    for tag, created_id in zip(
+        missing_collections, executor.map(create_smart_collection, missing_collections)
+    ):
+        if created_id:
+            existing_collections[tag] = created_id
+if missing_collections and smart_collections_fetched_at is not None:
+    save_smart_collections_cache(existing_collections)  # Nya collections ska inte skapas igen nästa körning
 
 # Auto-cleanup: Archive products not in XML feed anymore
+print(f"\n🔍 Found {len(feed_handles)} unique products in feed")
 archive_products_not_in_feed(feed_handles)
 
 # Calculate and display execution time
@@ -925,5 +1378,5 @@ minutes, seconds = divmod(remainder, 60)
 
 print(f"\n⏱️ Script completed at: {end_time.strftime('%Y-%m-%d %H:%M:%S')}")
 print(f"📊 Total execution time: {int(hours)}h {int(minutes)}m {int(seconds)}s")
-print(f"📦 Products processed: {len(grouped_products_list)}")
+print(f"📦 Products processed: {product_count}")
 print(f"✅ Products imported: {len(imported_product_ids)}")
@@ -4,37 +4,95 @@ import re
 import time
 import urllib.parse
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from ftplib import FTP
-from io import StringIO, BytesIO
+from io import BytesIO, TextIOWrapper
 from dotenv import load_dotenv
 from PIL import Image  # Pillow för bildhantering
 import json
 from datetime import datetime
 import base64
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 # Bildvaliderings-cache
 IMAGE_IMPORTED_CACHE_FILE = "deerhunter_image_imported.json"
 VALIDATION_CACHE_FILE = "deerhunter_validation_cache.json"
+# Append-only loggar (en JSON-rad per post) med ändringar sedan cachefilerna ovan senast skrevs
+IMAGE_IMPORTED_JOURNAL_FILE = "deerhunter_image_imported.jsonl"
+VALIDATION_JOURNAL_FILE = "deerhunter_validation_cache.jsonl"
 MAX_SIZE_MB = 16  # Google Shopping max (16MB)
 MAX_PIXELS = 8000  # Google Shopping max (64 megapixels ≈ 8000x8000)
 RESIZE_MAX_DIMENSION = 1500  # Google Shopping rekommendation (1500x1500)
+IMAGE_PROBE_BYTES = 64 * 1024  # Räcker för JPEG/PNG-headern i nästan alla bilder
+VALIDATION_CACHE_TTL = 7 * 24 * 3600  # Sekunder innan ett valideringsresultat kontrolleras igen
+
+# Antal bilder per produkt som hämtas/valideras samtidigt
+IMAGE_WORKERS = 8
+# Antal lyckade produkter mellan varje skrivning av progress-filen (skrivs även vid avslut)
+PROGRESS_FLUSH_INTERVAL = 25
+
+def open_journal(path, apply):
+    """
+    Spela upp en append-only logg (apply anropas med varje JSON-rad) och öppna den för nya rader.
+    Så går inga ändringar förlorade om en körning avbryts innan cachefilen hunnit skrivas.
+    """
+    journal_line = ""
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            for journal_line in f:
+                try:
+                    apply(json.loads(journal_line))
+                except ValueError:
+                    pass  # Halvskriven sista rad om körningen dödades mitt i en skrivning
+    journal = open(path, "a")
+    if journal_line and not journal_line.endswith("\n"):
+        journal.write("\n")  # Nya rader ska inte hamna efter en halvskriven rad
+    return journal
 
 if os.path.exists(IMAGE_IMPORTED_CACHE_FILE):
     with open(IMAGE_IMPORTED_CACHE_FILE, "r") as f:
         image_import_cache = json.load(f)
 else:
     image_import_cache = {}
+image_import_journal = open_journal(
+    IMAGE_IMPORTED_JOURNAL_FILE, lambda url: image_import_cache.__setitem__(url, True)
+)
 
 if os.path.exists(VALIDATION_CACHE_FILE):
     with open(VALIDATION_CACHE_FILE, "r") as f:
         image_validation_cache = json.load(f)
 else:
     image_validation_cache = {}
-
-def resize_image(image_data, max_dimension=RESIZE_MAX_DIMENSION):
-    """Resiza och optimera en bild till max dimension"""
+# Varje rad är [url, resultat]
+validation_journal = open_journal(
+    VALIDATION_JOURNAL_FILE, lambda entry: image_validation_cache.__setitem__(entry[0], entry[1])
+)
+validation_cache_lock = threading.Lock()
+
+# Egen session för bildhämtning: håller anslutningarna till bildservern öppna mellan bilderna
+# och delas av trådarna som validerar bilder
+image_session = requests.Session()
+image_session.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=IMAGE_WORKERS,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=frozenset(["GET", "HEAD"]),
+        raise_on_status=False,
+    ),
+))
+
+def resize_image(img, max_dimension=RESIZE_MAX_DIMENSION):
+    """Resiza och optimera en redan öppnad bild (PIL Image) till max dimension"""
     try:
-        img = Image.open(BytesIO(image_data))
+        # Låt JPEG-avkodaren skala ner direkt (1/2, 1/4, 1/8) istället för att avkoda hela bilden.
+        # Måste ske innan konverteringen nedan, som annars läser in bilden i full storlek.
+        img.draft('RGB', (max_dimension, max_dimension))
 
         # Konvertera RGBA/LA/P till RGB (ta bort alpha channel)
         if img.mode in ('RGBA', 'LA', 'P'):
@@ -50,9 +108,11 @@ def resize_image(image_data, max_dimension=RESIZE_MAX_DIMENSION):
         # Resiza med bibehållen aspect ratio
         img.thumbnail((max_dimension, max_dimension), Image.Resampling.LANCZOS)
 
-        # Spara optimerad som JPEG
+        # Spara som JPEG med standardtabeller. Bilden laddas upp en gång och markeras sedan som
+        # importerad, så ett extra Huffman-pass (optimize) skulle bara göra kodningen långsammare
+        # för några procents mindre fil; quality=85 avgör bildkvaliteten
         output = BytesIO()
-        img.save(output, format='JPEG', quality=85, optimize=True)
+        img.save(output, format='JPEG', quality=85, optimize=False, progressive=False)
         output.seek(0)
 
         return output.getvalue()
@@ -60,6 +120,63 @@ def resize_image(image_data, max_dimension=RESIZE_MAX_DIMENSION):
         print(f"⚠️ Kunde inte resiza bild: {e}")
         return None
 
+def fetch_image(url, max_bytes=None):
+    """
+    Hämta en bild, eller bara de första max_bytes (Range-anrop).
+    Returnerar (data, total storlek i bytes, svarets headers) eller None om bilden inte kunde hämtas.
+    Total storlek är None om servern svarade med en del av bilden utan att ange storleken.
+    Servrar som inte stödjer Range svarar med hela bilden (200), vilket också fungerar.
+    """
+    headers = {"Range": f"bytes=0-{max_bytes - 1}"} if max_bytes else None
+    resp = image_session.get(url, timeout=20, headers=headers)
+    if resp.status_code == 206:
+        total = resp.headers.get("Content-Range", "").rpartition("/")[2]
+        return resp.content, int(total) if total.isdigit() else None, resp.headers
+    if resp.status_code == 200:
+        return resp.content, len(resp.content), resp.headers
+    return None
+
+def fetch_full_image(url):
+    fetched = fetch_image(url)
+    if fetched is None:
+        raise IOError("Bild kunde inte hämtas")
+    return fetched[0]
+
+def get_cache_validators(headers):
+    """ETag/Last-Modified från bildservern, sparas i cacheposten för villkorlig omvalidering"""
+    validators = {}
+    if headers.get("ETag"):
+        validators["etag"] = headers["ETag"]
+    if headers.get("Last-Modified"):
+        validators["last_modified"] = headers["Last-Modified"]
+    return validators
+
+def is_validation_fresh(url, cache_entry):
+    """
+    Resultat äldre än VALIDATION_CACHE_TTL (eller utan checked_at) kontrolleras igen.
+    Finns ETag/Last-Modified räcker ett villkorligt HEAD-anrop: 304 betyder att bilden är
+    oförändrad, och resultatet gäller då en ny period. Annars valideras bilden om från början.
+    """
+    checked_at = cache_entry.get("checked_at")
+    if checked_at and time.time() - checked_at < VALIDATION_CACHE_TTL:
+        return True
+
+    headers = {}
+    if cache_entry.get("etag"):
+        headers["If-None-Match"] = cache_entry["etag"]
+    if cache_entry.get("last_modified"):
+        headers["If-Modified-Since"] = cache_entry["last_modified"]
+    if not headers:
+        return False
+    try:
+        resp = image_session.head(url, timeout=20, headers=headers)
+    except requests.exceptions.RequestException:
+        return False
+    if resp.status_code != 304:
+        return False
+    set_validation_result(url, cache_entry)  # Förnyar checked_at
+    return True
+
 def prepare_image_for_shopify(url):
     """
     Hämtar och förbereder en bild för Shopify.
@@ -71,9 +188,9 @@ def prepare_image_for_shopify(url):
     if not url:
         return None
 
-    # Kolla cache först
-    if url in image_validation_cache:
-        cache_entry = image_validation_cache[url]
+    # Kolla cache först (om resultatet fortfarande gäller)
+    cache_entry = image_validation_cache.get(url)
+    if cache_entry is not None and is_validation_fresh(url, cache_entry):
         if cache_entry.get("valid") and not cache_entry.get("resized"):
             return {"src": url}
         elif cache_entry.get("resized"):
@@ -83,17 +200,29 @@ def prepare_image_for_shopify(url):
             return None
 
     try:
-        # Försök hämta bilden
-        resp = requests.get(url, timeout=20)
-        if resp.status_code != 200:
+        # Hämta bara början av bilden först - dimensionerna står i headern och
+        # den totala storleken i Content-Range, så hela bilden behövs bara vid resize
+        fetched = fetch_image(url, IMAGE_PROBE_BYTES)
+        if fetched is None:
             print(f"⚠️ Bild kunde inte hämtas: {url}")
-            image_validation_cache[url] = {"valid": False, "failed": True}
+            set_validation_result(url, {"valid": False, "failed": True})
             return None
 
-        image_data = resp.content
-        img = Image.open(BytesIO(image_data))
+        image_data, total_size, response_headers = fetched
+        is_complete = len(image_data) == total_size
+        try:
+            img = Image.open(BytesIO(image_data))
+        except Exception:
+            if is_complete:
+                raise
+            img = None  # Headern fick inte plats i de första byten (t.ex. stor EXIF/ICC-data)
+        if img is None or total_size is None:
+            image_data = fetch_full_image(url)
+            total_size = len(image_data)
+            is_complete = True
+            img = Image.open(BytesIO(image_data))
         width, height = img.width, img.height
-        size_mb = len(image_data) / (1024 * 1024)
+        size_mb = total_size / (1024 * 1024)
 
         # Kolla om bilden behöver resizas
         needs_resize = (
@@ -104,7 +233,10 @@ def prepare_image_for_shopify(url):
 
         if needs_resize:
             print(f"📐 Resizar bild: {url} ({width}x{height}, {size_mb:.1f}MB) → max {RESIZE_MAX_DIMENSION}x{RESIZE_MAX_DIMENSION}")
-            resized_data = resize_image(image_data)
+            if not is_complete:
+                img = Image.open(BytesIO(fetch_full_image(url)))
+            # Återanvänd den öppnade bilden - Pillow har bara läst headern än så länge
+            resized_data = resize_image(img)
 
             if resized_data:
                 # Konvertera till base64 för Shopify attachment
@@ -116,12 +248,13 @@ def prepare_image_for_shopify(url):
                     filename = os.path.splitext(filename)[0] + '.jpg'
 
                 # Cacha att denna bild behöver resizas
-                image_validation_cache[url] = {
+                set_validation_result(url, {
                     "valid": True,
                     "resized": True,
                     "original_size": f"{width}x{height}",
-                    "original_mb": round(size_mb, 1)
-                }
+                    "original_mb": round(size_mb, 1),
+                    **get_cache_validators(response_headers)
+                })
 
                 return {
                     "attachment": base64_data,
@@ -129,21 +262,22 @@ def prepare_image_for_shopify(url):
                 }
             else:
                 print(f"⚠️ Kunde inte resiza bild: {url}")
-                image_validation_cache[url] = {"valid": False, "failed": True}
+                set_validation_result(url, {"valid": False, "failed": True})
                 return None
         else:
             # Bilden är OK som den är
-            image_validation_cache[url] = {
+            set_validation_result(url, {
                 "valid": True,
                 "width": width,
                 "height": height,
-                "size_mb": round(size_mb, 1)
-            }
+                "size_mb": round(size_mb, 1),
+                **get_cache_validators(response_headers)
+            })
             return {"src": url}
 
     except Exception as e:
         print(f"⚠️ Bildproblem: {url} - {e}")
-        image_validation_cache[url] = {"valid": False, "failed": True}
+        set_validation_result(url, {"valid": False, "failed": True})
         return None
 
 def is_valid_shopify_image(url):
@@ -151,21 +285,41 @@ def is_valid_shopify_image(url):
     result = prepare_image_for_shopify(url)
     return result is not None
 
+def set_validation_result(url, entry):
+    entry = {**entry, "checked_at": int(time.time())}
+    # Bilderna valideras i flera trådar; låset hindrar att cachen ändras medan den sparas
+    with validation_cache_lock:
+        image_validation_cache[url] = entry
+        validation_journal.write(json.dumps([url, entry]) + "\n")
+        validation_journal.flush()
+
 def is_image_imported(url):
     return image_import_cache.get(url, False)
 
 def mark_image_imported(url):
+    # En rad i loggen istället för att skriva om hela cachefilen för varje bild
+    if url in image_import_cache:
+        return
     image_import_cache[url] = True
-    with open(IMAGE_IMPORTED_CACHE_FILE, "w") as f:
-        json.dump(image_import_cache, f)
+    image_import_journal.write(json.dumps(url) + "\n")
+    image_import_journal.flush()
+
+def write_file_atomic(path, data):
+    # Skriv till en temporär fil och byt ut atomiskt, så att en avbruten skrivning inte lämnar en trasig cache
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
 
 def save_image_import_cache():
-    with open(IMAGE_IMPORTED_CACHE_FILE, "w") as f:
-        json.dump(image_import_cache, f)
+    write_file_atomic(IMAGE_IMPORTED_CACHE_FILE, json.dumps(image_import_cache))
+    # Allt i loggen finns nu i cachefilen
+    image_import_journal.truncate(0)
 
 def save_validation_cache():
-    with open(VALIDATION_CACHE_FILE, "w") as f:
-        json.dump(image_validation_cache, f)
+    with validation_cache_lock:
+        write_file_atomic(VALIDATION_CACHE_FILE, json.dumps(image_validation_cache))
+        validation_journal.truncate(0)
 
 import atexit
 @atexit.register
@@ -192,57 +346,209 @@ if not FTP_HOST or not FTP_USERNAME or not FTP_PASSWORD or not FTP_FILE_PATH:
     exit()
 
 SHOPIFY_API_ENDPOINT = f"https://{SHOPIFY_STORE_URL}/admin/api/2023-04/products.json"
+# Produktfälten som skriptet läser; övriga (body_html, options, metafält m.m.) hämtas inte
+SHOPIFY_PRODUCT_FIELDS = "id,handle,title,vendor,status,variants,images"
 SHOPIFY_SMART_COLLECTIONS_ENDPOINT = f"https://{SHOPIFY_STORE_URL}/admin/api/2023-04/smart_collections.json"
+# GraphQL körs mot 2024-04: inventorySetQuantities (som kan sätta "available") finns inte i 2023-04
+SHOPIFY_GRAPHQL_ENDPOINT = f"https://{SHOPIFY_STORE_URL}/admin/api/2024-04/graphql.json"
+
+# Max antal lagerändringar per inventorySetQuantities-anrop (Shopifys gräns)
+INVENTORY_BATCH_SIZE = 250
+# Vänta in GraphQL-bucketen när färre kostnadspoäng än så här finns kvar
+GRAPHQL_MIN_AVAILABLE = 200
+INVENTORY_SET_MUTATION = """
+mutation inventorySetQuantities($input: InventorySetQuantitiesInput!) {
+  inventorySetQuantities(input: $input) {
+    userErrors { field message }
+  }
+}
+"""
+
+# Shopifys REST-bucket: sov bara när den är fylld till mer än 80%
+SHOPIFY_THROTTLE_THRESHOLD = 0.8
+SHOPIFY_LEAK_RATE = 2  # Anrop per sekund som bucketen töms med (standardplan)
+SHOPIFY_MAX_BACKOFF = 32  # Max väntetid i sekunder vid upprepade 429
+
+class ShopifyBucket:
+    """
+    Client-side copy of Shopify's REST leaky bucket.
+    The fill level is read from X-Shopify-Shop-Api-Call-Limit ("used/max") after every response
+    and drained at the leak rate in between, so wait() only sleeps before a call when the
+    bucket is close to full. Shared by all threads using the Shopify session.
+    """
+    def __init__(self, leak_rate=SHOPIFY_LEAK_RATE, threshold=SHOPIFY_THROTTLE_THRESHOLD):
+        self.leak_rate = leak_rate
+        self.threshold = threshold
+        self.used = 0.0
+        self.capacity = 40
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _level(self, now):
+        return max(0.0, self.used - (now - self.updated_at) * self.leak_rate)
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            over = self._level(now) + 1 - self.threshold * self.capacity
+            if over > 0:
+                time.sleep(over / self.leak_rate)
+                now = time.monotonic()
+            # Räkna med anropet direkt så att parallella trådar inte alla ser en tom bucket
+            self.used = self._level(now) + 1
+            self.updated_at = now
+
+    def update(self, response, *args, **kwargs):
+        """Response hook: sync the level with what Shopify reports."""
+        call_limit = response.headers.get("X-Shopify-Shop-Api-Call-Limit")
+        if not call_limit:
+            return
+        try:
+            used, capacity = map(int, call_limit.split("/"))
+        except ValueError:
+            return
+        with self.lock:
+            self.used = used
+            self.capacity = capacity
+            self.updated_at = time.monotonic()
+
+shopify_bucket = ShopifyBucket()
+
+class ShopifySession(requests.Session):
+    """Session som väntar in Shopifys bucket före varje anrop"""
+    def request(self, *args, **kwargs):
+        shopify_bucket.wait()
+        return super().request(*args, **kwargs)
+
+class ShopifyRetry(Retry):
+    """
+    Retry som även försöker om POST vid 429. Shopify har då avvisat anropet utan att utföra det,
+    så det är säkert att skicka igen (Retry-After respekteras). Andra fel på POST försöks inte om,
+    eftersom anropet då kan ha skapat resursen.
+    Vid upprepade 429 fördubblas väntetiden från Retry-After, upp till SHOPIFY_MAX_BACKOFF sekunder.
+    """
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method == "POST" and status_code == 429:
+            return bool(self.total)
+        return super().is_retry(method, status_code, has_retry_after)
+
+    def parse_retry_after(self, retry_after):
+        # Shopify skickar decimaltal ("Retry-After: 2.0"), vilket urllib3 annars avvisar med ett undantag
+        try:
+            return max(float(retry_after), 0.0)
+        except ValueError:
+            return super().parse_retry_after(retry_after)
+
+    def sleep_for_retry(self, response=None):
+        retry_after = self.get_retry_after(response)
+        if retry_after:
+            attempt = max(len(self.history) - 1, 0)
+            time.sleep(min(retry_after * 2 ** attempt, SHOPIFY_MAX_BACKOFF))
+            return True
+        return False
+
+# En gemensam session för alla Shopify-anrop: återanvänder TCP/TLS-anslutningar (keep-alive)
+# och försöker igen vid 429/5xx (POST bara vid 429, se ShopifyRetry).
+shopify_session = ShopifySession()
+shopify_session.headers.update({
+    "Content-Type": "application/json",
+    "X-Shopify-Access-Token": SHOPIFY_API_KEY,
+})
+shopify_session.mount("https://", HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=32,
+    max_retries=ShopifyRetry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=frozenset(["GET", "PUT"]),
+        raise_on_status=False,
+    ),
+))
+shopify_session.hooks["response"].append(shopify_bucket.update)
+
+# Lagerplatsen hämtas en gång per körning (sätts av get_location_id)
+shopify_location_id = None
+
+# Alla produkter i butiken per handle (sätts av prefetch_shopify_products, None = ej hämtad)
+shopify_products_by_handle = None
 
 def download_csv_content_from_ftp():
     print(f"DEBUG: Försöker ansluta till FTP: {FTP_HOST}")
     try:
         ftp = FTP(FTP_HOST)
         ftp.login(user=FTP_USERNAME, passwd=FTP_PASSWORD)
-        data = []
-        ftp.retrbinary(f"RETR {FTP_FILE_PATH}", lambda chunk: data.append(chunk))
+        # Chunkarna skrivs rakt in i en buffert; texten avkodas löpande när CSV:n läses
+        csv_buffer = BytesIO()
+        ftp.retrbinary(f"RETR {FTP_FILE_PATH}", csv_buffer.write)
         ftp.quit()
-        csv_bytes = b"".join(data)
-        csv_text = csv_bytes.decode("utf-8-sig")
+        csv_buffer.seek(0)
         print("✅ CSV-filens innehåll hämtat direkt från FTP.")
-        return csv_text
+        return TextIOWrapper(csv_buffer, encoding="utf-8-sig", newline="")
     except Exception as e:
         print(f"❌ Fel vid FTP-nedladdning: {e}")
         exit()
 
 def read_csv_data_from_ftp():
-    csv_text = download_csv_content_from_ftp()
-    csv_file = StringIO(csv_text)
-    first_line = csv_file.readline()
-    if first_line.strip().lower().startswith("sep="):
-        print("DEBUG: Hittade 'sep=' rad, hoppar över den.")
-    else:
-        csv_file.seek(0)
-    reader = csv.DictReader(csv_file, delimiter=";", quotechar='"')
-    print(f"DEBUG: CSV Header: {reader.fieldnames}")
+    csv_file = download_csv_content_from_ftp()
     rows = []
-    row_index = 0
-    for row in reader:
-        row_index += 1
-        product_name = row.get("Product_Name", "").strip()
-        if not product_name:
-            print(f"DEBUG: Skipping row #{row_index} p.g.a. saknad Product_Name.")
-            continue
-        rows.append(row)
+    # Texten avkodas först när den läses här, så avkodningsfel fångas på samma sätt som vid nedladdningen
+    try:
+        first_line = csv_file.readline()
+        if first_line.strip().lower().startswith("sep="):
+            print("DEBUG: Hittade 'sep=' rad, hoppar över den.")
+        else:
+            csv_file.seek(0)
+        reader = csv.DictReader(csv_file, delimiter=";", quotechar='"')
+        print(f"DEBUG: CSV Header: {reader.fieldnames}")
+        row_index = 0
+        for row in reader:
+            row_index += 1
+            product_name = row.get("Product_Name", "").strip()
+            if not product_name:
+                print(f"DEBUG: Skipping row #{row_index} p.g.a. saknad Product_Name.")
+                continue
+            rows.append(row)
+    except UnicodeDecodeError as e:
+        print(f"❌ Fel vid FTP-nedladdning: {e}")
+        exit()
+    finally:
+        # Släpp bufferten med rådata direkt när raderna är inlästa
+        csv_file.close()
     print(f"DEBUG: read_csv_data_from_ftp returnerar {len(rows)} rader.")
     return rows
 
+# Normalize Swedish characters to match Shopify's ASCII conversion; dots become dashes
+# and ½/® are dropped (½ counts as a word character for the regex below)
+HANDLE_TRANSLATION = str.maketrans({"å": "a", "ä": "a", "ö": "o", ".": "-", "½": None, "®": None})
+HANDLE_NON_WORD_RE = re.compile(r"[^\w\s-]")
+# Whitespace and dashes in any mix collapse to a single dash
+HANDLE_SEPARATOR_RE = re.compile(r"[\s-]+")
+
+@functools.lru_cache(maxsize=None)
 def create_handle(title):
-    handle = title.lower()
-    # Normalize Swedish characters to match Shopify's ASCII conversion
-    handle = handle.replace("å", "a").replace("ä", "a").replace("ö", "o")
-    handle = re.sub(r"½", "", handle)
-    handle = re.sub(r"®", "", handle)
-    handle = re.sub(r"\.", "-", handle)
-    handle = re.sub(r"[^\w\s-]", "", handle)
-    handle = re.sub(r"\s+", "-", handle.strip())
-    handle = re.sub(r"-+", "-", handle)
-    return handle
+    handle = title.lower().translate(HANDLE_TRANSLATION)
+    handle = HANDLE_NON_WORD_RE.sub("", handle)
+    return HANDLE_SEPARATOR_RE.sub("-", handle.strip())
+
+# Kategoritaggar utifrån ord i produktnamnet (gemener), i den ordning taggarna läggs till
+KEYWORD_TAGS = [
+    (("byxa", "byxor"), "Byxor"),
+    (("t-shirt",), "T-shirts"),
+    (("jacka",), "Jackor"),
+    (("mössa", "keps", "cap", "hatt"), "Mössor och Kepsar"),
+    (("piké",), "Pike"),
+    (("bag",), "Väskor"),
+    (("strumpor", "sockor", "socks"), "Strumpor"),
+    (("handske", "vante", "vantar", "glove", "handskar"), "Handskar"),
+    (("shorts",), "Shorts"),
+    (("skjorta",), "Skjortor"),
+    (("tröja", "sweater", "cardigan", "fleece"), "Tröjor"),
+    (("väst",), "Västar"),
+    (("bälte",), "Bälten"),
+    (("skärp",), "Skärp"),
+    (("leggings", "under"), "Baslager"),
+]
 
 def group_products(rows):
     groups = {}
@@ -253,6 +559,7 @@ def group_products(rows):
         groups.setdefault(product_number, []).append(row)
     return groups
 
+@functools.lru_cache(maxsize=4096)
 def get_base_without_hash(filename):
     """
     Remove hash/UUID suffixes from filenames.
@@ -292,6 +599,14 @@ def get_base_without_hash(filename):
 
     return filename.lower()
 
+@functools.lru_cache(maxsize=8192)
+def get_image_base(src):
+    """
+    Dedupe key for an image URL/src: basename without extension and hash/UUID suffixes.
+    Memoized since the same Shopify and feed URLs are compared on every update.
+    """
+    return get_base_without_hash(os.path.splitext(os.path.basename(src))[0])
+
 def transform_group_to_product(group):
     first = group[0]
     product_name = first.get("Product_Name", "").strip()
@@ -315,40 +630,34 @@ def transform_group_to_product(group):
     if series:
         tags.append(series)
     name_lower = product_name.lower()
-    if "byxa" in name_lower or "byxor" in name_lower:
-        tags.append("Byxor")
-    if "t-shirt" in name_lower:
-        tags.append("T-shirts")
-    if "jacka" in name_lower:
-        tags.append("Jackor")
-    if "mössa" in name_lower or "keps" in name_lower or "cap" in name_lower or "hatt" in name_lower:
-        tags.append("Mössor och Kepsar")
-    if "piké" in name_lower:
-        tags.append("Pike")
-    if "bag" in name_lower:
-        tags.append("Väskor")
-    if "strumpor" in name_lower or "sockor" in name_lower or "socks" in name_lower:
-        tags.append("Strumpor")
-    if "handske" in name_lower or "vante" in name_lower or "vantar" in name_lower or "glove" in name_lower or "handskar" in name_lower:
-        tags.append("Handskar")
-    if "shorts" in name_lower:
-        tags.append("Shorts")
-    if "skjorta" in name_lower:
-        tags.append("Skjortor")
-    if "tröja" in name_lower or "sweater" in name_lower or "cardigan" in name_lower or "fleece" in name_lower:
-        tags.append("Tröjor")
-    if "väst" in name_lower:
-        tags.append("Västar")
-    if "bälte" in name_lower:
-        tags.append("Bälten")
-    if "skärp" in name_lower:
-        tags.append("Skärp")
-    if "leggings" in name_lower or "under" in name_lower:
-        tags.append("Baslager")
+    for keywords, tag in KEYWORD_TAGS:
+        if any(keyword in name_lower for keyword in keywords):
+            tags.append(tag)
 
-    variants = []
+    image_fields = ["Image_URL", "Image1", "Image2", "Image3", "Image4", "Image5", "Image6", "Image7"]
+
+    # Validera gruppens bilder parallellt (nätverksbundet) innan varianterna byggs
+    candidate_urls = {}
+    for row in group:
+        for field in image_fields:
+            url = row.get(field, "").strip()
+            if url and not is_image_imported(url):
+                candidate_urls[url] = None
+    candidate_urls = list(candidate_urls)
+    with ThreadPoolExecutor(max_workers=IMAGE_WORKERS) as executor:
+        validation_results = list(executor.map(is_valid_shopify_image, candidate_urls))
     image_urls = set()
+    for url, is_valid in zip(candidate_urls, validation_results):
+        if is_valid:
+            image_urls.add(url)
+        else:
+            print(f"🚫 Skippad bild pga storlek/problem: {url}")
+
+    variants = []
     variant_image_map = {}
+    # Unika färger/storlekar i flödets ordning (dict som ordnad mängd)
+    colors = {}
+    sizes = {}
 
     for row in group:
         sku = f"{row.get('Product_Number','').strip()}-{row.get('Colour_Number','').strip()}-{row.get('Size','').strip()}"
@@ -422,16 +731,11 @@ def transform_group_to_product(group):
             variant["compare_at_price"] = compare_str
 
         variants.append(variant)
+        if size:
+            sizes[size] = None
 
-        image_fields = ["Image_URL", "Image1", "Image2", "Image3", "Image4", "Image5", "Image6", "Image7"]
-        for field in image_fields:
-            url = row.get(field, "").strip()
-            if url and url not in image_urls and not is_image_imported(url):
-                if is_valid_shopify_image(url):
-                    image_urls.add(url)
-                else:
-                    print(f"🚫 Skippad bild pga storlek/problem: {url}")
         if color:
+            colors[color] = None
             lower_color = color.lower()
             if lower_color not in variant_image_map:
                 for field in image_fields:
@@ -446,11 +750,9 @@ def transform_group_to_product(group):
         print(f"⚠️ Skippade produkt (alla varianter har pris = 0 kr): {product_name}")
         return None
 
-    colors = list({v["option1"] for v in variants if v["option1"]})
-    sizes = list({v["option2"] for v in variants if v["option2"]})
     options = [
-        {"name": "Color", "values": colors},
-        {"name": "Size",  "values": sizes}
+        {"name": "Color", "values": list(colors)},
+        {"name": "Size",  "values": list(sizes)}
     ]
 
     primary_tag = f"handle:{handle}"
@@ -479,34 +781,57 @@ def transform_group_to_product(group):
     }
     return product_payload
 
+def prefetch_shopify_products():
+    """
+    Fetch all products in the store (all vendors, like the handle lookup) once,
+    so create-vs-update can be decided locally instead of one GET per product.
+    Returns False if any page fails; lookups then fall back to per-handle GETs.
+    """
+    global shopify_products_by_handle
+    products_by_handle = {}
+    url = f"{SHOPIFY_API_ENDPOINT}?limit=250&fields={SHOPIFY_PRODUCT_FIELDS}"
+    while url:
+        resp = shopify_session.get(url)
+        if resp.status_code != 200:
+            print(f"❌ Failed to prefetch products from Shopify: {resp.status_code}")
+            print(resp.text)
+            return False
+        for product in resp.json().get("products", []):
+            if product.get("handle"):
+                products_by_handle[product["handle"]] = product
+        url = resp.links.get("next", {}).get("url")
+
+    shopify_products_by_handle = products_by_handle
+    print(f"   Found {len(products_by_handle)} existing products on Shopify")
+    return True
+
 def find_product_by_handle(product_title):
-    headers = {
-        "Content-Type": "application/json",
-        "X-Shopify-Access-Token": SHOPIFY_API_KEY,
-    }
+    """
+    Return the existing Shopify product (dict with id, handle, variants, images) or None.
+    """
     handle = create_handle(product_title)
-    search_url = f"https://{SHOPIFY_STORE_URL}/admin/api/2023-04/products.json?handle={handle}"
-    response = requests.get(search_url, headers=headers)
+    if shopify_products_by_handle is not None:
+        return shopify_products_by_handle.get(handle)
+    search_url = f"{SHOPIFY_API_ENDPOINT}?handle={handle}&fields={SHOPIFY_PRODUCT_FIELDS}"
+    response = shopify_session.get(search_url)
     if response.status_code == 200:
         data = response.json()
         products = data.get("products", [])
         if products:
-            return products[0]["id"]
+            return products[0]
     return None
 
-def update_product(product_id, product_data):
-    headers = {
-        "Content-Type": "application/json",
-        "X-Shopify-Access-Token": SHOPIFY_API_KEY,
-    }
+def update_product(product_id, product_data, current_product=None):
     product_url = f"https://{SHOPIFY_STORE_URL}/admin/api/2023-04/products/{product_id}.json"
-    current_resp = requests.get(product_url, headers=headers)
-    if current_resp.status_code != 200:
-        print(f"❌ Failed to fetch current product {product_id}: {current_resp.text}")
-        return None
-    current_product = current_resp.json().get("product", {})
+    if current_product is None:
+        current_resp = shopify_session.get(f"{product_url}?fields=id,variants,images")
+        if current_resp.status_code != 200:
+            print(f"❌ Failed to fetch current product {product_id}: {current_resp.text}")
+            return None
+        current_product = current_resp.json().get("product", {})
     current_variants = current_product.get("variants", [])
-    current_map = {v.get("sku", "").lower(): v for v in current_variants}
+    # Shopify returnerar "sku": null för varianter utan SKU
+    current_map = {(v.get("sku") or "").lower(): v for v in current_variants}
     for new_var in product_data.get("variants", []):
         new_sku = new_var.get("sku", "").lower()
         if new_sku in current_map:
@@ -523,63 +848,55 @@ def update_product(product_id, product_data):
         else:
             current_variants.append(new_var)
     current_images = current_product.get("images", [])
+    existing_bases = {get_image_base(existing.get("src", "") or "") for existing in current_images}
     for image in product_data.get("images", []):
         # Kan vara antingen {"src": url} eller {"attachment": ..., "filename": ...}
         if image.get("src"):
             # URL-baserad bild
             src = image.get("src")
-            base = get_base_without_hash(os.path.splitext(os.path.basename(src))[0])
-            duplicate_found = any(
-                base == get_base_without_hash(os.path.splitext(os.path.basename(existing.get("src", "") or ""))[0])
-                for existing in current_images
-            )
-            if not duplicate_found:
+            base = get_image_base(src)
+            if base not in existing_bases:
                 current_images.append({"src": src})
+                existing_bases.add(base)
         elif image.get("attachment"):
             # Resizad bild som attachment
             filename = image.get("filename", "image.jpg")
             base = get_base_without_hash(os.path.splitext(filename)[0])
-            duplicate_found = any(
-                base == get_base_without_hash(os.path.splitext(os.path.basename(existing.get("src", "") or ""))[0])
-                for existing in current_images
-            )
-            if not duplicate_found:
+            if base not in existing_bases:
                 current_images.append(image)
+                existing_bases.add(base)
     updated_data = {
         "id": product_id,
         "variants": current_variants,
         "images": current_images,
     }
     payload = {"product": updated_data}
-    update_resp = requests.put(product_url, json=payload, headers=headers)
+    update_resp = shopify_session.put(product_url, json=payload)
     if update_resp.status_code == 200:
         print(f"✅ Successfully updated product: {product_data['title']} (ID: {product_id}) with updated price/inventory, variants and images.")
-        return product_id
+        # Svaret innehåller den uppdaterade produkten - återanvänds istället för nya GET-anrop
+        return update_resp.json().get("product", {"id": product_id})
     else:
         print(f"❌ Failed to update product: {product_data['title']} (ID: {product_id})")
         print(update_resp.text)
         return None
 
-def assign_variant_images(product_id, variant_image_map):
-    headers = {
-        "Content-Type": "application/json",
-        "X-Shopify-Access-Token": SHOPIFY_API_KEY,
-    }
+def assign_variant_images(product_id, variant_image_map, product=None):
     product_url = f"https://{SHOPIFY_STORE_URL}/admin/api/2023-04/products/{product_id}.json"
-    product_resp = requests.get(product_url, headers=headers)
-    if product_resp.status_code != 200:
-        print(f"❌ Failed to fetch product {product_id} for variant image assignment: {product_resp.text}")
-        return
-    product_data = product_resp.json().get("product", {})
+    if product is None:
+        product_resp = shopify_session.get(product_url)
+        if product_resp.status_code != 200:
+            print(f"❌ Failed to fetch product {product_id} for variant image assignment: {product_resp.text}")
+            return
+        product = product_resp.json().get("product", {})
+    product_data = product
     image_mapping = {}
     for img in product_data.get("images", []):
-        src = img.get("src", "")
-        base = get_base_without_hash(os.path.splitext(os.path.basename(src))[0])
-        image_mapping[base] = img.get("id")
+        image_mapping[get_image_base(img.get("src", ""))] = img.get("id")
     updated_variants = []
     for variant in product_data.get("variants", []):
-        sku = variant.get("sku", "").lower()
-        color_in_variant = variant.get("option1", "").lower()
+        sku = (variant.get("sku") or "").lower()
+        color_in_variant = (variant.get("option1") or "").lower()
         assigned_image_url = variant_image_map.get(sku) or variant_image_map.get(color_in_variant)
         if assigned_image_url:
             feed_identifier = get_base_without_hash(
@@ -590,42 +907,77 @@ def assign_variant_images(product_id, variant_image_map):
                 variant["image_id"] = found_image_id
         updated_variants.append(variant)
     update_payload = {"product": {"id": product_id, "variants": updated_variants}}
-    update_resp = requests.put(product_url, json=update_payload, headers=headers)
+    update_resp = shopify_session.put(product_url, json=update_payload)
     if update_resp.status_code != 200:
         print(f"❌ Failed to update variant image assignments for product {product_id}: {update_resp.text}")
 
-def update_inventory_levels(product_id, product_data):
-    headers = {
-        "Content-Type": "application/json",
-        "X-Shopify-Access-Token": SHOPIFY_API_KEY,
-    }
+def get_location_id():
+    global shopify_location_id
+    if shopify_location_id:
+        return shopify_location_id
     locations_url = f"https://{SHOPIFY_STORE_URL}/admin/api/2023-04/locations.json"
-    loc_resp = requests.get(locations_url, headers=headers)
+    loc_resp = shopify_session.get(locations_url)
     if loc_resp.status_code != 200:
         print(f"❌ CRITICAL: Failed to fetch locations for inventory update!")
         print(f"   Status code: {loc_resp.status_code}")
         print(f"   Error: {loc_resp.text}")
         print(f"   ⚠️  Inventory levels will NOT be updated! Check API permissions (read_locations scope required)")
-        return
+        return None
     locations = loc_resp.json().get("locations", [])
     if not locations:
         print("❌ CRITICAL: No locations found! Inventory levels will NOT be updated!")
+        return None
+    shopify_location_id = locations[0]["id"]
+    print(f"📍 Using location ID: {shopify_location_id} for inventory updates")
+    return shopify_location_id
+
+def shopify_graphql(query, variables=None):
+    """
+    Run a GraphQL Admin API request. Returns the "data" dict, or None if the request
+    failed (HTTP error or top-level GraphQL errors such as THROTTLED).
+    """
+    resp = shopify_session.post(
+        SHOPIFY_GRAPHQL_ENDPOINT, json={"query": query, "variables": variables or {}}
+    )
+    if resp.status_code != 200:
+        print(f"❌ GraphQL request failed ({resp.status_code}): {resp.text}")
+        return None
+    body = resp.json()
+
+    # GraphQL har en egen bucket (kostnadspoäng), rapporterad i extensions.cost.throttleStatus
+    throttle_status = body.get("extensions", {}).get("cost", {}).get("throttleStatus")
+    if throttle_status:
+        available = throttle_status.get("currentlyAvailable", 0)
+        restore_rate = throttle_status.get("restoreRate") or 50
+        if available < GRAPHQL_MIN_AVAILABLE:
+            time.sleep((GRAPHQL_MIN_AVAILABLE - available) / restore_rate)
+
+    if body.get("errors"):
+        print(f"❌ GraphQL errors: {body['errors']}")
+        return None
+    return body.get("data") or {}
+
+def update_inventory_levels(product_id, product_data, product=None):
+    location_id = get_location_id()
+    if not location_id:
         return
-    location_id = locations[0]["id"]
-    print(f"📍 Using location ID: {location_id} for inventory updates")
-    product_url = f"https://{SHOPIFY_STORE_URL}/admin/api/2023-04/products/{product_id}.json"
-    prod_resp = requests.get(product_url, headers=headers)
-    if prod_resp.status_code != 200:
-        print(f"❌ Failed to fetch product {product_id} for inventory update: {prod_resp.text}")
-        return
-    product = prod_resp.json().get("product", {})
+    if product is None:
+        product_url = f"https://{SHOPIFY_STORE_URL}/admin/api/2023-04/products/{product_id}.json"
+        prod_resp = shopify_session.get(product_url)
+        if prod_resp.status_code != 200:
+            print(f"❌ Failed to fetch product {product_id} for inventory update: {prod_resp.text}")
+            return
+        product = prod_resp.json().get("product", {})
     shopify_variants = product.get("variants", [])
     sku_to_inventory_item_id = {}
     for variant in shopify_variants:
-        sku = variant.get("sku", "").lower()
+        sku = (variant.get("sku") or "").lower()
         inventory_item_id = variant.get("inventory_item_id")
         if sku and inventory_item_id:
             sku_to_inventory_item_id[sku] = inventory_item_id
+    # Samla alla lagernivåer för produkten och skicka dem i en GraphQL-mutation
+    # istället för ett inventory_levels/set-anrop per SKU
+    set_quantities = []
     for variant in product_data.get("variants", []):
         sku = variant.get("sku", "").lower()
         desired_qty = variant.get("inventory_quantity", 0)
@@ -633,65 +985,75 @@ def update_inventory_levels(product_id, product_data):
         if not inventory_item_id:
             print(f"❌ No inventory_item_id found for SKU: {sku}")
             continue
-        update_url = f"https://{SHOPIFY_STORE_URL}/admin/api/2023-04/inventory_levels/set.json"
-        payload = {
-            "location_id": location_id,
-            "inventory_item_id": inventory_item_id,
-            "available": desired_qty
-        }
-        inv_resp = requests.post(update_url, json=payload, headers=headers)
-        if inv_resp.status_code == 200:
-            print(f"✅ Inventory for SKU {sku} updated to {desired_qty}")
+        set_quantities.append({
+            "inventoryItemId": f"gid://shopify/InventoryItem/{inventory_item_id}",
+            "locationId": f"gid://shopify/Location/{location_id}",
+            "quantity": desired_qty,
+        })
+
+    for start in range(0, len(set_quantities), INVENTORY_BATCH_SIZE):
+        batch = set_quantities[start:start + INVENTORY_BATCH_SIZE]
+        data = shopify_graphql(
+            INVENTORY_SET_MUTATION,
+            {"input": {
+                # Sätt tillgängligt antal (som inventory_levels/set.json gjorde), inte on hand -
+                # annars dras redan reserverade/beställda enheter av från flödets antal
+                "name": "available",
+                "reason": "correction",
+                "ignoreCompareQuantity": True,
+                "quantities": batch,
+            }},
+        )
+        if data is None:
+            print(f"❌ Failed to update inventory for product {product_id}")
+            continue
+        user_errors = data.get("inventorySetQuantities", {}).get("userErrors", [])
+        if user_errors:
+            print(f"❌ Failed to update inventory for product {product_id}: {user_errors}")
         else:
-            print(f"❌ Failed to update inventory for SKU {sku}: {inv_resp.text}")
-        time.sleep(0.6)
+            print(f"✅ Inventory updated for {len(batch)} SKU(s)")
 
 def send_to_shopify(product_data):
-    headers = {
-        "Content-Type": "application/json",
-        "X-Shopify-Access-Token": SHOPIFY_API_KEY,
-    }
-    existing_id = find_product_by_handle(product_data["title"])
+    existing = find_product_by_handle(product_data["title"])
     error_text = ""
-    if existing_id:
-        prod_id = update_product(existing_id, product_data)
-        if not prod_id:
+    if existing:
+        product = update_product(existing["id"], product_data, existing)
+        if not product:
             error_text = "Kunde inte uppdatera produkt (se logg ovan)"
     else:
-        response = requests.post(SHOPIFY_API_ENDPOINT, json={"product": product_data}, headers=headers)
+        response = shopify_session.post(SHOPIFY_API_ENDPOINT, json={"product": product_data})
         if response.status_code == 201:
-            prod_id = response.json()["product"]["id"]
-            print(f"✅ Successfully added product: {product_data['title']} (ID: {prod_id})")
+            product = response.json()["product"]
+            print(f"✅ Successfully added product: {product_data['title']} (ID: {product['id']})")
         else:
             print(f"❌ Failed to add product: {product_data['title']}")
             print(f"Error: {response.text}")
-            prod_id = None
+            product = None
             error_text = response.text
+    prod_id = product["id"] if product else None
     if prod_id:
+        # Håll den förhämtade produktlistan aktuell om samma handle dyker upp igen
+        if shopify_products_by_handle is not None and product.get("handle"):
+            shopify_products_by_handle[product["handle"]] = product
+
         # Märk bilder som importerade (använd original-URLer)
         for url in product_data.get("all_image_urls", []):
             mark_image_imported(url)
 
-        update_inventory_levels(prod_id, product_data)
+        update_inventory_levels(prod_id, product_data, product)
         if "variant_image_map" in product_data:
-            assign_variant_images(prod_id, product_data["variant_image_map"])
+            assign_variant_images(prod_id, product_data["variant_image_map"], product)
         # Ensure product is published globally (visible on all sales channels)
         ensure_global_publication(prod_id)
     return prod_id, error_text
 
 def upload_additional_images(product_id, image_urls):
-    headers = {
-        "Content-Type": "application/json",
-        "X-Shopify-Access-Token": SHOPIFY_API_KEY,
-    }
     images_url = f"https://{SHOPIFY_STORE_URL}/admin/api/2023-04/products/{product_id}/images.json"
-    resp = requests.get(images_url, headers=headers)
+    resp = shopify_session.get(images_url)
     uploaded_basenames = set()
     if resp.status_code == 200:
         for img in resp.json().get("images", []):
-            filename = os.path.splitext(os.path.basename(img.get("src", "")))[0]
-            base = get_base_without_hash(filename)
-            uploaded_basenames.add(base)
+            uploaded_basenames.add(get_image_base(img.get("src", "")))
     for url in image_urls[1:]:
         filename = os.path.splitext(os.path.basename(urllib.parse.urlparse(url).path))[0]
         base = get_base_without_hash(filename)
@@ -706,10 +1068,9 @@ def upload_additional_images(product_id, image_urls):
             continue
 
         payload = {"image": image_data}
-        resp = requests.post(
+        resp = shopify_session.post(
             f"https://{SHOPIFY_STORE_URL}/admin/api/2023-04/products/{product_id}/images.json",
             json=payload,
-            headers=headers,
         )
         try:
             resp_json = resp.json()
@@ -722,14 +1083,9 @@ def upload_additional_images(product_id, image_urls):
             print(f"🔄 Bild redan uppladdad (eller exakt samma url): {url}")
         else:
             print(f"❌ Misslyckades med bild: {url} – Fel: {resp_json or resp.text}")
-        time.sleep(1.0)
 
 def get_existing_smart_collections():
-    headers = {
-        "Content-Type": "application/json",
-        "X-Shopify-Access-Token": SHOPIFY_API_KEY,
-    }
-    response = requests.get(SHOPIFY_SMART_COLLECTIONS_ENDPOINT, headers=headers)
+    response = shopify_session.get(SHOPIFY_SMART_COLLECTIONS_ENDPOINT)
     if response.status_code == 200:
         data = response.json()
         return {sc["title"]: sc["id"] for sc in data.get("smart_collections", [])}
@@ -747,11 +1103,6 @@ def ensure_global_publication(product_id):
     Ensure product is published with global scope, making it visible on all sales channels
     including Online Store, Google & YouTube, Facebook & Instagram, etc.
     """
-    headers = {
-        "Content-Type": "application/json",
-        "X-Shopify-Access-Token": SHOPIFY_API_KEY,
-    }
-
     # Update product to have global published_scope
     url = f"https://{SHOPIFY_STORE_URL}/admin/api/2023-04/products/{product_id}.json"
     payload = {
@@ -762,7 +1113,7 @@ def ensure_global_publication(product_id):
         }
     }
 
-    resp = requests.put(url, json=payload, headers=headers)
+    resp = shopify_session.put(url, json=payload)
 
     if resp.status_code == 200:
         print(f"   📢 Product published globally (visible on all sales channels)")
@@ -776,16 +1127,23 @@ def get_all_deerhunter_products_from_shopify():
     Fetch all Deerhunter products from Shopify.
     Returns a dict with handle as key and product data as value.
     """
-    headers = {
-        "Content-Type": "application/json",
-        "X-Shopify-Access-Token": SHOPIFY_API_KEY,
-    }
+    if shopify_products_by_handle is not None:
+        # Återanvänd produkterna som hämtades i början av körningen (hålls aktuella under importen)
+        return {
+            handle: {
+                "id": product.get("id"),
+                "title": product.get("title"),
+                "status": product.get("status")
+            }
+            for handle, product in shopify_products_by_handle.items()
+            if product.get("vendor") == "Deerhunter"
+        }
 
     all_products = {}
-    url = f"https://{SHOPIFY_STORE_URL}/admin/api/2023-04/products.json?vendor=Deerhunter&limit=250"
+    url = f"https://{SHOPIFY_STORE_URL}/admin/api/2023-04/products.json?vendor=Deerhunter&limit=250&fields=id,handle,title,status"
 
     while url:
-        resp = requests.get(url, headers=headers)
+        resp = shopify_session.get(url)
         if resp.status_code != 200:
             print(f"❌ Failed to fetch Deerhunter products from Shopify: {resp.status_code}")
             print(resp.text)
@@ -814,8 +1172,6 @@ def get_all_deerhunter_products_from_shopify():
                     url = part.split(";")[0].strip("<> ")
                     break
 
-        time.sleep(0.5)  # Rate limiting
-
     return all_products
 
 def archive_products_not_in_feed(feed_handles, min_feed_size=400):
@@ -856,11 +1212,6 @@ def archive_products_not_in_feed(feed_handles, min_feed_size=400):
 
     print(f"\n📦 Found {len(to_archive)} products to archive:")
 
-    headers = {
-        "Content-Type": "application/json",
-        "X-Shopify-Access-Token": SHOPIFY_API_KEY,
-    }
-
     archived_count = 0
     for handle, product_data in to_archive:
         product_id = product_data["id"]
@@ -876,7 +1227,7 @@ def archive_products_not_in_feed(feed_handles, min_feed_size=400):
             }
         }
 
-        resp = requests.put(url, json=payload, headers=headers)
+        resp = shopify_session.put(url, json=payload)
         if resp.status_code == 200:
             print(f"      ✅ Archived successfully")
             archived_count += 1
@@ -885,8 +1236,6 @@ def archive_products_not_in_feed(feed_handles, min_feed_size=400):
             if resp.text:
                 print(f"         Error: {resp.text}")
 
-        time.sleep(0.6)  # Rate limiting
-
     print(f"\n✅ Auto-cleanup complete: {archived_count}/{len(to_archive)} products archived")
 
 def main():
@@ -920,6 +1269,21 @@ def main():
             last_completed_product = f.read().strip()
         print(f"⏩ Återupptar från produktnummer efter: {last_completed_product}")
 
+    print("🔍 Fetching existing products from Shopify...")
+    prefetch_shopify_products()
+
+    # Senast importerade produktnummer som ännu inte skrivits till progress-filen
+    pending_progress = None
+
+    def flush_progress():
+        nonlocal pending_progress
+        if pending_progress is not None:
+            write_file_atomic(progress_file, pending_progress)
+            pending_progress = None
+
+    # Ett avbrott mitt i körningen ska fortfarande kunna återupptas från senaste produkten
+    atexit.register(flush_progress)
+
     skipping = bool(last_completed_product)
     total_products = len(groups)
     processed_count = 0
@@ -941,18 +1305,19 @@ def main():
                     upload_additional_images(prod_id, all_image_urls)
                     assign_variant_images(prod_id, product_payload["variant_image_map"])
                 imported_ids.append(prod_id)
-                with open(progress_file, "w") as f:
-                    f.write(str(product_number))
-                save_image_cache()
+                pending_progress = str(product_number)
+                if len(imported_ids) % PROGRESS_FLUSH_INTERVAL == 0:
+                    flush_progress()
             else:
                 if error_msg:
                     failed_imports.append((product_payload['title'], error_msg))
                 else:
                     failed_imports.append((product_payload['title'], "API error eller ogiltigt svar"))
-            time.sleep(1.0)
         else:
             failed_imports.append((f"(Ingen payload, product_number: {product_number})", "Payload byggdes ej"))
 
+    # Importen är klar, progress-filen tas bort nedan i stället för att skrivas
+    atexit.unregister(flush_progress)
     print(f"Imported {len(imported_ids)} products successfully.")
     save_image_cache()
 